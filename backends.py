@@ -0,0 +1,29 @@
+from bs4 import BeautifulSoup
+from bs4.builder import builder_registry
+from tqdm import tqdm
+
+# html.parser ships with Python so it is always available. lxml and
+# html5lib are optional (pip install lxml) but lxml is several times faster.
+DEFAULT_PARSER = "html.parser"
+PARSERS = ("lxml", "html5lib", "html.parser")
+
+def is_available(name):
+    return builder_registry.lookup(name) is not None
+
+def get_parser(name=None):
+    """Pick the BeautifulSoup tree builder to use.
+
+    name can be any of PARSERS. If it is None or the parser isn't installed
+    html.parser is used instead.
+    """
+    if not name:
+        return DEFAULT_PARSER
+    if name not in PARSERS:
+        raise ValueError("Unknown html parser {}. Valid parsers are {}.".format(name, ", ".join(PARSERS)))
+    if not is_available(name):
+        tqdm.write("The {} parser is not installed, falling back to {}.".format(name, DEFAULT_PARSER))
+        return DEFAULT_PARSER
+    return name
+
+def make_soup(markup, parser=None):
+    return BeautifulSoup(markup, parser or DEFAULT_PARSER)
@@ -0,0 +1,218 @@
+import argparse
+import json
+import platform
+import subprocess
+import time
+import traceback
+
+from datetime import datetime, timezone
+from pathlib import Path
+
+import bs4
+import pythonbible as bible
+
+from tqdm import tqdm
+
+import bible_cache
+from backends import PARSERS, get_parser, make_soup
+from compare_parsers import chapter_files
+from generate_tif import TifWriter, serialize_verse, verse_node
+from model import decode_verses
+from parse import VerseText, find_class_verse, format_tag, parse_chapter
+from renderers import get_renderer
+from versions import load_configs
+
+# Time the hot paths of parse.py and generate_tif.py on the html and json
+# that ship with the repo. Results are saved as json so two revisions can be
+# compared with -c.
+
+# Psalm 119 is the longest chapter, Genesis 1 is a short narrative chapter
+# and Jeremiah 51 has the most footnotes in the ASV.
+CHAPTERS = [("Psalms", 119), ("Genesis", 1), ("Jeremiah", 51)]
+
+def read_html(config, book_name, chapter_num):
+    with open(Path("books", "input", config["version"], "html", "{}-{}.html".format(book_name, chapter_num)), "r", encoding='utf-8') as f:
+        return f.read()
+
+def read_verses(config, book_name, chapter_num):
+    with open(Path("books", "output", config["version"], config["output_format"], "{}-{}.json".format(book_name, chapter_num)), "rb") as f:
+        return decode_verses(f.read())
+
+def measure(function, calls=1, repeat=5):
+    """Run function repeat times and keep the fastest run.
+
+    One untimed run first fills the reference cache, so the numbers are
+    for the steady state of a long run. calls is how many items one run
+    handles and is used for the per call time.
+    """
+    function()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    best = min(times)
+    return {
+        "seconds": round(best, 6),
+        "mean_seconds": round(sum(times) / len(times), 6),
+        "calls": calls,
+        "per_call_us": round(best / calls * 1e6, 3) if calls else None,
+        "repeat": repeat
+    }
+
+def chapter_benchmarks(config, book_name, chapter_num, repeat):
+    html = read_html(config, book_name, chapter_num)
+    verses = read_verses(config, book_name, chapter_num)
+    soup = make_soup(html, config.get("parser"))
+    nodes = soup.find_all(class_="text")
+    spans = [node for node in nodes if node.name == "span"]
+    renderer = get_renderer(config["output_format"])
+
+    def run_format_tag():
+        for span in spans:
+            format_tag(renderer, VerseText(), span)
+
+    def run_find_class_verse():
+        for node in nodes:
+            find_class_verse(node)
+
+    def run_parse_chapter():
+        parse_chapter(config, book_name, chapter_num, html=html)
+
+    def run_verse_node():
+        for verse in verses:
+            verse_node(book_name, verse)
+
+    def run_serialize():
+        for verse in verses:
+            TifWriter.serialize(verse_node(book_name, verse))
+
+    def run_serialize_verse():
+        for verse in verses:
+            serialize_verse(book_name, verse)
+
+    return {
+        "format_tag": measure(run_format_tag, len(spans), repeat),
+        "find_class_verse": measure(run_find_class_verse, len(nodes), repeat),
+        "parse_chapter": measure(run_parse_chapter, 1, repeat),
+        "verse_node": measure(run_verse_node, len(verses), repeat),
+        "verse_node_serialized": measure(run_serialize, len(verses), repeat),
+        "serialize_verse": measure(run_serialize_verse, len(verses), repeat)
+    }
+
+def corpus_benchmarks(config):
+    """Parse every chapter and build every node once, like a full run."""
+    chapters = chapter_files(config["version"])
+    results = {}
+
+    start = time.perf_counter()
+    for book_name, chapter_num in tqdm(chapters, unit="chapter"):
+        parse_chapter(config, book_name, chapter_num)
+    seconds = time.perf_counter() - start
+    results["parse_chapter"] = {"seconds": round(seconds, 3), "calls": len(chapters), "per_call_us": round(seconds / len(chapters) * 1e6, 3)}
+
+    # Only the chapters parse.py saved (it skips each book's last chapter).
+    parsed = [c for c in chapters if Path("books", "output", config["version"], config["output_format"], "{}-{}.json".format(*c)).exists()]
+    count = 0
+    seconds = 0
+    serialized = 0
+    templated = 0
+    for book_name, chapter_num in tqdm(parsed, unit="chapter"):
+        verses = read_verses(config, book_name, chapter_num)
+        start = time.perf_counter()
+        nodes = [verse_node(book_name, verse) for verse in verses]
+        seconds += time.perf_counter() - start
+        start = time.perf_counter()
+        for node in nodes:
+            TifWriter.serialize(node)
+        serialized += time.perf_counter() - start
+        start = time.perf_counter()
+        for verse in verses:
+            serialize_verse(book_name, verse)
+        templated += time.perf_counter() - start
+        count += len(nodes)
+    results["verse_node"] = {"seconds": round(seconds, 3), "calls": count, "per_call_us": round(seconds / count * 1e6, 3)}
+    results["serialize"] = {"seconds": round(serialized, 3), "calls": count, "per_call_us": round(serialized / count * 1e6, 3)}
+    results["serialize_verse"] = {"seconds": round(templated, 3), "calls": count, "per_call_us": round(templated / count * 1e6, 3)}
+    return results
+
+def revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmarks(config, repeat=5, corpus=True):
+    report = {
+        "revision": revision(),
+        "date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "pythonbible": bible.__version__,
+        "beautifulsoup4": bs4.__version__,
+        "version": config["version"],
+        "output_format": config["output_format"],
+        "parser": config["parser"],
+        "chapters": {},
+        "corpus": None
+    }
+    for book_name, chapter_num in CHAPTERS:
+        print("{} {}".format(book_name, chapter_num))
+        report["chapters"]["{}-{}".format(book_name, chapter_num)] = chapter_benchmarks(config, book_name, chapter_num, repeat)
+    if corpus:
+        report["corpus"] = corpus_benchmarks(config)
+    report["cache"] = bible_cache.cache_stats()
+    return report
+
+def flatten(report):
+    """{"chapter/benchmark": seconds} for every timing in a report."""
+    timings = {}
+    for key, benchmarks in report["chapters"].items():
+        for name, result in benchmarks.items():
+            timings["{}/{}".format(key, name)] = result["seconds"]
+    for name, result in (report.get("corpus") or {}).items():
+        timings["corpus/{}".format(name)] = result["seconds"]
+    return timings
+
+def print_report(report, baseline=None):
+    timings = flatten(report)
+    before = flatten(baseline) if baseline else {}
+    for name, seconds in timings.items():
+        line = "{:45} {:>12.6f}s".format(name, seconds)
+        if before.get(name):
+            line += "  {:>+7.1%} vs {}".format(seconds / before[name] - 1, baseline.get("revision"))
+        print(line)
+
+if __name__ == '__main__':
+    try:
+        arg_desc = "Command line switches are optional."
+        parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description = arg_desc)
+
+        parser.add_argument("-v", "--version", help = "Version to benchmark. Defaults to the version in config.json.", required=False)
+        parser.add_argument("-p", "--parser", choices=PARSERS, help = "html parser used by BeautifulSoup. Defaults to html.parser.", required=False)
+        parser.add_argument("-n", "--repeat", type=int, default=5, help = "How many times each chapter benchmark is run. The fastest run is kept. Defaults to 5.", required=False)
+        parser.add_argument("--no-corpus", action="store_true", help = "Skip parsing and building nodes for the whole version.", required=False)
+        parser.add_argument("-o", "--output", help = "Save the results to this file. Defaults to books/output/benchmarks/{revision}.json.", required=False)
+        parser.add_argument("-c", "--compare", help = "Results saved by an earlier run to compare against.", required=False)
+
+        args = vars(parser.parse_args())
+
+        config = load_configs([args["version"]] if args["version"] else None)[0]
+        config["parser"] = get_parser(args["parser"])
+
+        report = run_benchmarks(config, args["repeat"], not args["no_corpus"])
+
+        baseline = None
+        if args["compare"]:
+            with open(Path(args["compare"]), "r") as f:
+                baseline = json.loads(f.read())
+        print_report(report, baseline)
+
+        output = Path(args["output"] or Path("books", "output", "benchmarks", "{}.json".format(report["revision"] or "latest")))
+        output.parent.mkdir(parents=True, exist_ok=True)
+        with open(output, "w") as f:
+            f.write(json.dumps(report, indent=4))
+        print("Saved {}".format(output))
+
+    except Exception:
+        traceback.print_exc()
@@ -0,0 +1,170 @@
+import json
+import os
+
+from functools import lru_cache
+from pathlib import Path
+
+import pythonbible as bible
+
+import verse_table
+
+# pythonbible parses reference strings with a lot of regular expressions.
+# The scripts ask it about the same strings and verse ids over and over (every
+# class token on a chapter page, every cross reference, every field of every
+# verse node) so all of those calls go through the caches below.
+
+CACHE_SIZE = 65536
+
+# Reference strings parsed by get_references, loaded from and saved to the
+# disk caches of the versions passed to load_disk_cache. Values are lists of
+# NormalizedReference fields so they can be saved as json.
+_disk = {}
+_disk_versions = []
+_disk_new = {}
+_disk_hits = 0
+
+def _to_fields(ref):
+    return [
+        ref.book.value,
+        ref.start_chapter,
+        ref.start_verse,
+        ref.end_chapter,
+        ref.end_verse,
+        ref.end_book.value if ref.end_book else None
+    ]
+
+def _from_fields(fields):
+    book, start_chapter, start_verse, end_chapter, end_verse, end_book = fields
+    return bible.NormalizedReference(
+        bible.Book(book),
+        start_chapter,
+        start_verse,
+        end_chapter,
+        end_verse,
+        bible.Book(end_book) if end_book else None
+    )
+
+def _key(ref):
+    # NormalizedReference is a mutable dataclass and can't be hashed.
+    return tuple(_to_fields(ref))
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _get_references(text):
+    global _disk_hits
+    if text in _disk:
+        _disk_hits += 1
+        return tuple(_from_fields(fields) for fields in _disk[text])
+
+    refs = tuple(bible.get_references(text))
+    if _disk_versions:
+        _disk[text] = _disk_new[text] = [_to_fields(ref) for ref in refs]
+    return refs
+
+def get_references(text):
+    # Hand out a new list so callers can't change the cached tuple.
+    return list(_get_references(text))
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _convert_reference_to_verse_ids(key):
+    # A range of verses that exist is a slice of the verse table. Anything
+    # else goes to pythonbible, which knows how to complain about it.
+    book, start_chapter, start_verse, end_chapter, end_verse, end_book = key
+    verse_ids = verse_table.get_table().expand_range(book, start_chapter, start_verse, end_book or book, end_chapter, end_verse)
+    if verse_ids is None:
+        return tuple(bible.convert_reference_to_verse_ids(_from_fields(key)))
+    return tuple(verse_ids)
+
+def convert_reference_to_verse_ids(ref):
+    return list(_convert_reference_to_verse_ids(_key(ref)))
+
+def convert_references_to_verse_ids(refs):
+    verse_ids = []
+    for ref in refs:
+        verse_ids.extend(_convert_reference_to_verse_ids(_key(ref)))
+    return verse_ids
+
+# The chapter and verse of a verse id come from the verse table, pythonbible
+# is only asked about verses outside it.
+@lru_cache(maxsize=CACHE_SIZE)
+def get_chapter_number(verse_id):
+    coordinates = verse_table.get_table().coordinates(verse_id)
+    return coordinates[1] if coordinates else bible.get_chapter_number(verse_id)
+
+@lru_cache(maxsize=CACHE_SIZE)
+def get_verse_number(verse_id):
+    coordinates = verse_table.get_table().coordinates(verse_id)
+    return coordinates[2] if coordinates else bible.get_verse_number(verse_id)
+
+@lru_cache(maxsize=None)
+def get_book(name):
+    """The pythonbible Book for a name or abbreviation (i.e. "1Chr"), None if it isn't one."""
+    refs = get_references(name)
+    return refs[0].book if refs else None
+
+@lru_cache(maxsize=None)
+def get_book_titles(book):
+    return bible.get_book_titles(book)
+
+def cache_path(version):
+    return Path("books", "output", version, "cache", "references.json")
+
+def load_disk_cache(version):
+    """Use (and remember) parsed reference strings for this version.
+
+    Strings already saved in books/output/{version}/cache/references.json
+    skip pythonbible's parser entirely. Reference strings mean the same
+    thing in every version, so when several versions are loaded their
+    caches are merged and save_disk_cache writes the result to each of them.
+    """
+    _disk_versions.append(version)
+    path = cache_path(version)
+    if path.exists():
+        with open(path, "r", encoding='utf-8') as f:
+            saved = json.loads(f.read())
+        # A different pythonbible may parse strings differently.
+        if saved.get("pythonbible") == bible.__version__:
+            _disk.update(saved["references"])
+    _get_references.cache_clear()
+
+def pop_new_entries():
+    """Return (and forget) the strings parsed since the last call.
+
+    Worker processes send these back to the parent process, which merges
+    them with merge_entries before saving.
+    """
+    global _disk_new
+    entries = _disk_new
+    _disk_new = {}
+    return entries
+
+def merge_entries(entries):
+    _disk.update(entries)
+    _disk_new.update(entries)
+
+def save_disk_cache():
+    if not _disk_new:
+        return
+    for version in _disk_versions:
+        path = cache_path(version)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(".tmp")
+        with open(tmp, "w", encoding='utf-8') as f:
+            f.write(json.dumps({"pythonbible": bible.__version__, "references": _disk}, sort_keys=True))
+        os.replace(tmp, path)
+    _disk_new.clear()
+
+def cache_stats():
+    """Hits and misses for each cached call."""
+    stats = {}
+    for name, function in (
+        ("get_references", _get_references),
+        ("convert_reference_to_verse_ids", _convert_reference_to_verse_ids),
+        ("get_chapter_number", get_chapter_number),
+        ("get_verse_number", get_verse_number),
+        ("get_book", get_book),
+        ("get_book_titles", get_book_titles)
+    ):
+        info = function.cache_info()
+        stats[name] = {"hits": info.hits, "misses": info.misses, "size": info.currsize}
+    stats["get_references"]["disk_hits"] = _disk_hits
+    return stats
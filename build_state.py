@@ -0,0 +1,72 @@
+import hashlib
+import json
+import os
+
+from pathlib import Path
+
+import pythonbible as bible
+
+# Fingerprints used to skip work whose inputs haven't changed since the last
+# run. A chapter is rebuilt when its input, the relevant config settings or
+# the code that processes it changes.
+
+SOURCE_FOLDER = Path(__file__).resolve().parent
+
+def digest(*parts):
+    h = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode("utf-8")
+        h.update(part)
+        # Keep ("ab", "c") and ("a", "bc") apart.
+        h.update(b"\0")
+    return h.hexdigest()
+
+def file_digest(path):
+    with open(path, "rb") as f:
+        return digest(f.read())
+
+def code_fingerprint(filenames):
+    """Fingerprint of the source files (next to this one) that do the work.
+
+    The pythonbible version is included because it decides how references
+    are parsed.
+    """
+    parts = [bible.__version__]
+    for filename in filenames:
+        with open(Path(SOURCE_FOLDER, filename), "rb") as f:
+            parts.append(f.read())
+    return digest(*parts)
+
+def config_fingerprint(config, keys):
+    return digest(json.dumps({key: config.get(key) for key in keys}, sort_keys=True))
+
+class BuildState:
+    """What was built from each chapter in the last run, saved as json.
+
+    Each entry holds the chapter's fingerprint plus whatever else the caller
+    wants to keep about it (i.e. the problems found while parsing it).
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self.entries = {}
+        if self.path.exists():
+            with open(self.path, "r", encoding='utf-8') as f:
+                self.entries = json.loads(f.read())
+
+    def is_current(self, key, fingerprint):
+        entry = self.entries.get(key)
+        return entry is not None and entry["fingerprint"] == fingerprint
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def record(self, key, fingerprint, **extra):
+        self.entries[key] = dict(extra, fingerprint=fingerprint)
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix(".tmp")
+        with open(tmp, "w", encoding='utf-8') as f:
+            f.write(json.dumps(self.entries, indent=4, sort_keys=True))
+        os.replace(tmp, self.path)
@@ -0,0 +1,86 @@
+import argparse
+import json
+import time
+import traceback
+
+from pathlib import Path
+
+from tqdm import tqdm
+
+from backends import DEFAULT_PARSER, PARSERS, is_available
+from model import encode_chapter
+from parse import parse_chapter
+from versions import load_configs
+
+# Parse every downloaded chapter with each html parser and compare the verse
+# json against html.parser. If a faster parser produces the same json for the
+# whole corpus it is safe to use with parse.py -p.
+
+def chapter_files(version):
+    """List (book name, chapter number) for every html file of a version."""
+    chapters = []
+    for path in sorted(Path("books", "input", version, "html").glob("*.html")):
+        book_name, chapter_num = path.stem.rsplit("-", 1)
+        chapters.append((book_name, int(chapter_num)))
+    return chapters
+
+def compare_parsers(config, parsers, limit=None):
+    """Returns {parser: {"seconds", "chapters", "different": [chapter, ...]}}."""
+    chapters = chapter_files(config["version"])[:limit]
+    report = {}
+    expected = {}
+
+    # The reference parser runs first so the others can be compared to it.
+    for parser in [DEFAULT_PARSER] + [p for p in parsers if p != DEFAULT_PARSER]:
+        print(parser)
+        this_config = dict(config, parser=parser)
+        different = []
+        seconds = 0
+        for book_name, chapter_num in tqdm(chapters, unit="chapter"):
+            start = time.perf_counter()
+            this_book, problems = parse_chapter(this_config, book_name, chapter_num)
+            seconds += time.perf_counter() - start
+
+            output = encode_chapter(this_book)
+            key = "{}-{}".format(book_name, chapter_num)
+            if parser == DEFAULT_PARSER:
+                expected[key] = output
+            elif output != expected[key]:
+                different.append(key)
+
+        report[parser] = {
+            "seconds": round(seconds, 3),
+            "chapters": len(chapters),
+            "different": different
+        }
+    return report
+
+if __name__ == '__main__':
+    try:
+        arg_desc = "Command line switches are optional."
+        parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description = arg_desc)
+
+        parser.add_argument("-v", "--version", help = "Version to compare. Defaults to the version in config.json.", required=False)
+        parser.add_argument("-p", "--parsers", nargs = "+", choices=PARSERS, help = "Parsers to compare against html.parser. Defaults to every installed parser.", required=False)
+        parser.add_argument("-n", "--limit", type=int, help = "Only compare the first n chapters (sorted by file name).", required=False)
+        parser.add_argument("-o", "--output", help = "Save the report as json to this file.", required=False)
+
+        args = vars(parser.parse_args())
+
+        config = load_configs([args["version"]] if args["version"] else None)[0]
+        parsers = [p for p in (args["parsers"] or PARSERS) if is_available(p)]
+
+        report = compare_parsers(config, parsers, args["limit"])
+
+        for name, result in report.items():
+            print("{}: {} chapters in {}s, {} different from {}.".format(
+                name, result["chapters"], result["seconds"], len(result["different"]), DEFAULT_PARSER))
+            for key in result["different"]:
+                print("    {}".format(key))
+
+        if args["output"]:
+            with open(Path(args["output"]), "w") as f:
+                f.write(json.dumps(report, indent=4))
+
+    except Exception:
+        traceback.print_exc()
@@ -0,0 +1,314 @@
+import argparse
+import re
+import traceback
+
+from array import array
+from pathlib import Path
+
+import pythonbible as bible
+
+from tqdm import tqdm
+
+import bible_cache
+import instrument
+from build_state import code_fingerprint, digest, file_digest
+from mapped_arrays import MappedArrays, read_header, save_arrays
+from model import decode_verses
+from store import VerseStore, store_path
+from versions import load_configs
+
+# Every cross reference and every verse linked in a footnote, resolved once
+# to verse id ranges. generate_tif.py (or anything else) can then ask what a
+# verse points to, and what points to it, without parsing reference strings
+# or reading the whole version again.
+#
+# The index is a set of int32 arrays in compressed sparse row (CSR) layout:
+#
+#   sources           sorted verse ids that have links
+#   source_offsets    the links of sources[i] are edges[source_offsets[i]:source_offsets[i + 1]]
+#   edge_kinds        FOOTNOTE or CROSSREF
+#   edge_notes        which of the verse's footnotes / crossrefs the link is in
+#   edge_starts       first verse id of the linked range
+#   edge_ends         last verse id of the linked range
+#   targets           sorted verse ids that are linked to (every verse of a range)
+#   target_offsets    the verses linking to targets[i] are referrers[target_offsets[i]:target_offsets[i + 1]]
+#   referrers         source verse ids
+#
+# They are saved one after another in books/output/{version}/index/crossrefs.bin,
+# with crossrefs.json saying where each one starts, and read back with mmap.
+
+FOOTNOTE = 0
+CROSSREF = 1
+
+ARRAYS = ["sources", "source_offsets", "edge_kinds", "edge_notes", "edge_starts", "edge_ends",
+    "targets", "target_offsets", "referrers"]
+
+# Source files whose changes mean the index has to be built again.
+INDEX_SOURCES = ["crossref_index.py", "bible_cache.py", "model.py", "mapped_arrays.py", "verse_table.py"]
+
+# Verses linked in a footnote, i.e. "See [[Rom. 15:6]] margin."
+FOOTNOTE_LINK = re.compile(r"\[\[(.+?)\]\]")
+# "verse 13", "verses 7-8": in the chapter of the verse the note belongs to.
+VERSES = re.compile(r"[Vv]erses? (.+)")
+# "10" or "10-12" after another reference: verses of that reference's chapter.
+BARE_VERSES = re.compile(r"\d+(-\d+)?$")
+# "9:37": a chapter of the book of the reference before it.
+CHAPTER_VERSE = re.compile(r"\d+:\d+")
+# "Job 38:26-Job 38:28", which pythonbible can't parse.
+BOOK_RANGE = re.compile(r"(.+\d)\s*-\s*((?:\d\s*)?[A-Za-z].*\d)$")
+# "Gen. 3:7f" or "3:7ff": the following verses aren't counted.
+FOLLOWING = re.compile(r"(\d)f+$")
+# Abbreviations used in the ASV footnotes that pythonbible doesn't know.
+ABBREVIATIONS = {
+    "Mt.": "Matthew",
+    "Mk.": "Mark",
+    "Lk.": "Luke",
+    "Dt.": "Deuteronomy",
+    "Ex.": "Exodus",
+    "Am.": "Amos",
+    "S. S.": "Song of Songs"
+}
+
+def index_folder(version):
+    return Path("books", "output", version, "index")
+
+def _get_references(text):
+    try:
+        return bible_cache.get_references(text)
+    except ValueError:
+        return []
+
+def _book_range(text):
+    # Join the start of the first reference to the end of the last.
+    m = BOOK_RANGE.match(text)
+    if not m:
+        return []
+    first = _get_references(m.group(1))
+    last = _get_references(m.group(2))
+    if len(first) != 1 or len(last) != 1 or first[0].book != last[0].book:
+        return []
+    return [bible.NormalizedReference(first[0].book, first[0].start_chapter, first[0].start_verse,
+        last[0].end_chapter, last[0].end_verse)]
+
+def resolve_reference(text, verse_id, context=None):
+    """pythonbible references for a cross reference or footnote link.
+
+    verse_id is the verse the note belongs to. context is the (book,
+    chapter) of the reference before this one in the same note, so the
+    "10" in "2 Chr. 2:8, 9, 10" is 2 Chronicles 2:10. Returns the references
+    ([] when the text isn't one) and the context for the next reference.
+    """
+    book = bible.Book(verse_id // 1000000)
+    chapter = bible_cache.get_chapter_number(verse_id)
+    if context is None:
+        context = (book, chapter)
+
+    text = FOLLOWING.sub(r"\1", text.strip().replace("–", "-"))
+    for abbreviation, title in ABBREVIATIONS.items():
+        if text.startswith(abbreviation + " "):
+            text = title + text[len(abbreviation):]
+            break
+
+    m = VERSES.match(text)
+    if m:
+        text = "{} {}:{}".format(book.title, chapter, m.group(1))
+    elif BARE_VERSES.match(text):
+        text = "{} {}:{}".format(context[0].title, context[1], text)
+    elif CHAPTER_VERSE.match(text):
+        text = "{} {}".format(context[0].title, text)
+
+    refs = _get_references(text) or _book_range(text)
+    if refs:
+        context = (refs[-1].book, refs[-1].end_chapter)
+    return refs, context
+
+def verse_links(verse):
+    """Yield (kind, note, references) for every link in a Verse's notes."""
+    for note_num, note in enumerate(verse.footnotes):
+        context = None
+        for text in FOOTNOTE_LINK.findall(note.text):
+            refs, context = resolve_reference(text, verse.verse_id, context)
+            if refs:
+                yield FOOTNOTE, note_num, refs
+    # A list like "Gen 3.7, 10, 11" is split into one cross reference per
+    # item, so the book and chapter carry over from one to the next until
+    # the key (the letter in the verse) changes.
+    context = None
+    key = None
+    for note_num, note in enumerate(verse.crossrefs):
+        if note.ref != key:
+            context = None
+            key = note.ref
+        refs, context = resolve_reference(note.text, verse.verse_id, context)
+        if refs:
+            yield CROSSREF, note_num, refs
+
+def read_verses(config, store=None):
+    """Every parsed Verse of a version, from the chapter json or the verse store."""
+    if store:
+        for book, chapter, verse in store.read_books([book.value for book in bible.Book]):
+            yield verse
+        return
+    for path in tqdm(sorted(Path("books", "output", config["version"], config["output_format"]).glob("*.json")), unit="chapter"):
+        with open(path, "rb") as f:
+            yield from decode_verses(f.read())
+
+def input_fingerprint(config, use_store=False, sources=INDEX_SOURCES):
+    """Fingerprint of the parsed verses and the code (sources) that indexes them."""
+    if use_store:
+        inputs = [store_path(config["version"], config["output_format"])]
+    else:
+        inputs = sorted(Path("books", "output", config["version"], config["output_format"]).glob("*.json"))
+    return digest(code_fingerprint(sources), *[
+        "{} {}".format(path.name, file_digest(path)) for path in inputs])
+
+def build_arrays(verses):
+    """The CSR arrays (see the top of this file) for an iterable of Verses."""
+    edges = {}
+    referrers = {}
+    for verse in verses:
+        for kind, note_num, refs in verse_links(verse):
+            for ref in refs:
+                verse_ids = bible_cache.convert_reference_to_verse_ids(ref)
+                if not verse_ids:
+                    continue
+                edges.setdefault(verse.verse_id, []).append((kind, note_num, verse_ids[0], verse_ids[-1]))
+                for verse_id in verse_ids:
+                    referrers.setdefault(verse_id, set()).add(verse.verse_id)
+
+    arrays = {name: array("i") for name in ARRAYS}
+    arrays["source_offsets"].append(0)
+    for verse_id in sorted(edges):
+        arrays["sources"].append(verse_id)
+        for kind, note_num, start, end in edges[verse_id]:
+            arrays["edge_kinds"].append(kind)
+            arrays["edge_notes"].append(note_num)
+            arrays["edge_starts"].append(start)
+            arrays["edge_ends"].append(end)
+        arrays["source_offsets"].append(len(arrays["edge_kinds"]))
+
+    arrays["target_offsets"].append(0)
+    for verse_id in sorted(referrers):
+        arrays["targets"].append(verse_id)
+        arrays["referrers"].extend(sorted(referrers[verse_id]))
+        arrays["target_offsets"].append(len(arrays["referrers"]))
+    return arrays
+
+def index_path(folder):
+    return Path(folder, "crossrefs.bin")
+
+def save_index(folder, arrays, fingerprint):
+    save_arrays(index_path(folder), {name: arrays[name] for name in ARRAYS}, fingerprint=fingerprint)
+
+class CrossrefIndex:
+    """The index saved by build_index, read with mmap.
+
+    Looking a verse up is a dict lookup for its row and a slice of the
+    arrays, the arrays themselves are only paged in as they are used.
+    """
+    def __init__(self, folder):
+        self.folder = Path(folder)
+        if read_header(index_path(self.folder)) is None:
+            raise FileNotFoundError("No cross reference index in {}. Run crossref_index.py first.".format(self.folder))
+        self._mapped = MappedArrays(index_path(self.folder))
+        self.header = self._mapped.header
+        self.arrays = self._mapped.arrays
+
+        self._source_rows = {verse_id: row for row, verse_id in enumerate(self.arrays["sources"])}
+        self._target_rows = {verse_id: row for row, verse_id in enumerate(self.arrays["targets"])}
+
+    @property
+    def fingerprint(self):
+        return self.header["fingerprint"]
+
+    def references_from(self, verse_id):
+        """[(kind, note, first verse id, last verse id), ...] linked from a verse."""
+        row = self._source_rows.get(verse_id)
+        if row is None:
+            return []
+        a = self.arrays
+        start, end = a["source_offsets"][row], a["source_offsets"][row + 1]
+        return list(zip(a["edge_kinds"][start:end], a["edge_notes"][start:end], a["edge_starts"][start:end], a["edge_ends"][start:end]))
+
+    def note_targets(self, verse_id, kind, note_num):
+        """[(first verse id, last verse id), ...] linked from one of a verse's notes."""
+        return [(start, end) for k, n, start, end in self.references_from(verse_id) if k == kind and n == note_num]
+
+    def references_to(self, verse_id):
+        """The verse ids whose footnotes or cross references link to verse_id."""
+        row = self._target_rows.get(verse_id)
+        if row is None:
+            return []
+        offsets = self.arrays["target_offsets"]
+        return self.arrays["referrers"][offsets[row]:offsets[row + 1]].tolist()
+
+    def close(self):
+        self._mapped.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+def build_index(config, use_store=False, force=False):
+    """Build books/output/{version}/index unless it is already up to date."""
+    folder = index_folder(config["version"])
+    fingerprint = input_fingerprint(config, use_store)
+    header = read_header(index_path(folder))
+    if header and header["fingerprint"] == fingerprint and not force:
+        print("The index for {} is up to date.".format(config["version"]))
+        return
+
+    store = None
+    if use_store:
+        path = store_path(config["version"], config["output_format"])
+        if not path.exists():
+            raise FileNotFoundError("No verse store at {}. Run parse.py -s first.".format(path))
+        store = VerseStore(path)
+    try:
+        arrays = build_arrays(read_verses(config, store))
+    finally:
+        if store:
+            store.close()
+    save_index(folder, arrays, fingerprint)
+    print("Indexed {} links from {} verses to {} verses.".format(len(arrays["edge_kinds"]), len(arrays["sources"]), len(arrays["targets"])))
+
+def print_links(config, text):
+    with CrossrefIndex(index_folder(config["version"])) as index:
+        for ref in bible_cache.get_references(text):
+            for verse_id in bible_cache.convert_reference_to_verse_ids(ref):
+                print(verse_id)
+                for kind, note_num, start, end in index.references_from(verse_id):
+                    print("  {} {} -> {}{}".format("footnote" if kind == FOOTNOTE else "crossref", note_num, start, "" if start == end else "-{}".format(end)))
+                for source in index.references_to(verse_id):
+                    print("  <- {}".format(source))
+
+def add_arguments(parser):
+    parser.add_argument("-v", "--versions", nargs = "+", help = "Versions to index. Each must be the default version or listed under versions in config.json. If ommited the default version in config.json is indexed.", required=False)
+    parser.add_argument("-s", "--store", action="store_true", help = "Read the verses from the verse store saved by parse.py -s instead of the chapter json files.", required=False)
+    parser.add_argument("--force", action="store_true", help = "Build the index even if the parsed verses haven't changed.", required=False)
+    parser.add_argument("-q", "--query", help = "Print the links from and to a reference (i.e. \"Gen 1:1\") instead of building the index.", required=False)
+    parser.add_argument("--no-cache", action="store_true", help = "Don't load or save parsed references in books/output/{version}/cache.", required=False)
+    instrument.add_arguments(parser)
+
+def main(args):
+    try:
+        for config in load_configs(args["versions"]):
+            if not args["no_cache"]:
+                bible_cache.load_disk_cache(config["version"])
+            if args["query"]:
+                print_links(config, args["query"])
+                continue
+            with instrument.stage("index {}".format(config["version"])):
+                build_index(config, args["store"], args["force"])
+        bible_cache.save_disk_cache()
+
+    except Exception:
+        traceback.print_exc()
+
+if __name__ == '__main__':
+    arg_desc = "Command line switches are optional."
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description = arg_desc)
+    add_arguments(parser)
+    instrument.run(main, vars(parser.parse_args()), "crossref_index")
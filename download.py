@@ -1,9 +1,14 @@
+import argparse
+import hashlib
 import json
+import os
+import threading
 import time
 import urllib3
 import requests
 import traceback
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 from urllib3 import Retry
 
@@ -13,16 +18,322 @@ from bs4 import BeautifulSoup, NavigableString, Tag, ResultSet
 from requests.adapters import HTTPAdapter, Retry
 from tqdm import tqdm
 
-if __name__ == '__main__':
-    with open(Path("config.json"), "r") as f:
-        config = json.loads(f.read())
+import bible_cache
+import instrument
+from backends import PARSERS, get_parser, make_soup
+from versions import load_configs
+
+class RateLimiter:
+    """Token bucket shared by every download thread.
+
+    rate is the number of requests per second that are allowed on average,
+    burst is how many requests can be made back to back before waiting.
+    A rate of 0 (or None) disables the limiter.
+    """
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.rate:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+def get_session(jobs=1):
+    s = requests.Session()
+    retries = Retry(total=5, backoff_factor=1, status_forcelist=[ 502, 503, 504 ])
+    # Every worker thread shares this session, so size the connection pool
+    # to match or urllib3 will throw away connections between requests.
+    s.mount('http://', HTTPAdapter(max_retries=retries, pool_maxsize=max(10, jobs)))
+    s.mount('https://', HTTPAdapter(max_retries=retries, pool_maxsize=max(10, jobs)))
+    return s
+
+def get_chapter_jobs(s, config):
+    """Read the version's book list from BibleGateway.
+
+    Returns the book_info object that is saved to chapters_{version}.json and
+    a list of (title, chapter) tuples that need to be downloaded.
+    """
+    book_url = "https://www.biblegateway.com/versions/{human_name}-{version}-Bible/#booklist".format(
+        human_name=config["human_name"],
+        version=config["version"]
+    )
+
+    book_info = {
+        "version": config["version"],
+        "books": []
+    }
+    jobs = []
+
+    resp = s.get(book_url)
+    soup = make_soup(resp.text, config.get("parser"))
+    stop = False
+
+    for row in soup.find("table", {"class", "chapterlinks"}).find_all("tr"):
+        count = 1
+        ref = None
+        links = row.find_all("a")
+
+        # See notes about apocrypha.
+        if stop:
+            break
+        try:
+            found = {}
+            skip = False
+            for link in links:
+                if stop:
+                    break
+                if not skip:
+                    # Try to turn the href title into a book-chaper reference
+                    ref = bible_cache.get_references(link.attrs["title"])
+                    if ref:
+                        # Only get the book of the Protestant canon (Genesis as 1 through Revelation as 66)
+                        if 1 <= ref[0].book.value <= 66:
+                            if bible_cache.get_book_titles(ref[0].book):
+                                title = bible_cache.get_book_titles(ref[0].book).short_title
+                        else:
+                            tqdm.write("Skipping {}.".format(link.attrs["title"]))
+                            skip = True
+                            # Stop fetching books.
+                            stop = True
+                            continue
+                    else:
+                        tqdm.write("Couldn't get pythonbible ref for {}.".format(link.attrs["title"]))
+                        skip = True
+                        continue
+
+                    jobs.append((title, count))
+
+                count = count + 1
+            if not stop:
+                found = {
+                    "name": title,
+                    "chapters": count - 1
+                }
+                book_info["books"].append(found)
+        except bible.errors.InvalidChapterError as e:
+            tqdm.write("WARNING: " + str(e))
+            continue
+
+    return book_info, jobs
+
+class Manifest:
+    """Record of every chapter that has been downloaded for a version.
+
+    The manifest is saved next to chapters_{version}.json as
+    manifest_{version}.json. Each entry is keyed by the html file name
+    (i.e. Genesis-1) and holds the url, byte size, sha256 of the saved html
+    and the ETag / Last-Modified headers BibleGateway sent with it.
+    """
+    def __init__(self, version):
+        self.path = Path("books", "input", version, "manifest_{}.json".format(version))
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.dirty = 0
+        if self.path.exists():
+            with open(self.path, "r", encoding='utf-8') as f:
+                self.entries = json.loads(f.read())
+
+    def get(self, key):
+        with self.lock:
+            return self.entries.get(key)
+
+    def update(self, key, entry, save_every=25):
+        with self.lock:
+            self.entries[key] = entry
+            self.dirty += 1
+            if self.dirty >= save_every:
+                self._save()
+
+    def save(self):
+        with self.lock:
+            self._save()
+
+    def _save(self):
+        # Write to a temporary file first so a crash never leaves a half
+        # written manifest behind.
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix(".tmp")
+        with open(tmp, "w", encoding='utf-8') as f:
+            f.write(json.dumps(dict(sorted(self.entries.items())), indent=4))
+        os.replace(tmp, self.path)
+        self.dirty = 0
+
+def is_complete(entry, file_path):
+    """Check that the html on disk is what the manifest says was saved."""
+    if not entry or not file_path.exists():
+        return False
+    if file_path.stat().st_size != entry["size"]:
+        return False
+    with open(file_path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest() == entry["sha256"]
+
+def chapter_url(version, title, chapter):
+    return "https://www.biblegateway.com/passage/?search={title}%20{chapter}&version={version}&interface=print".format(
+        title=title,
+        chapter=chapter,
+        version=version
+    )
+
+def fetch_passage(s, limiter, url, headers=None, parser=None):
+    """Request a chapter page and cut out the passage html.
 
+    Returns the response and the passage as utf-8 bytes, or None for the
+    passage when BibleGateway answered a conditional GET with 304. Raises
+    an error for an error response (i.e. 403, 429 or 404) or a page without
+    a passage, so nothing is saved over a good chapter.
+    """
+    limiter.wait()
+    r = s.get(url, headers=headers or {})
+    if r.status_code == 304:
+        return r, None
+    r.raise_for_status()
+
+    passage_soup = make_soup(r.text, parser)
+    passage = passage_soup.find(class_="passage-col")
+    if passage is None:
+        raise ValueError("No passage in {}".format(url))
+    return r, str(passage).encode("utf-8")
+
+def download_chapter(s, limiter, version, title, chapter, manifest=None, revalidate=False, parser=None):
+    """Download one chapter and save the passage html.
+
+    Returns "downloaded", "skipped" (already complete, no request sent) or
+    "not modified" (BibleGateway answered a conditional GET with 304).
+    """
+    # Download the html
+    path = chapter_url(version, title, chapter)
+
+    chapter_path = Path("books", "input", version, "html")
+    key = "{}-{}".format(title, chapter)
+    file_path = Path(chapter_path, "{}.html".format(key))
+
+    headers = {}
+    entry = manifest.get(key) if manifest else None
+    if is_complete(entry, file_path) and entry["url"] == path:
+        if not revalidate:
+            return "skipped"
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+
+    start = time.perf_counter()
+    r, content = fetch_passage(s, limiter, path, headers, parser)
+    if content is None:
+        instrument.record(instrument.chapter_key(version, title, chapter), seconds=time.perf_counter() - start)
+        return "not modified"
+
+    chapter_path.mkdir(parents=True, exist_ok=True)
+
+    # Save through a temporary file so an interrupted run can't leave a
+    # truncated chapter behind.
+    tmp = file_path.with_suffix(".tmp")
+    with open(tmp, "wb") as f:
+        f.write(content)
+    os.replace(tmp, file_path)
+
+    if manifest:
+        manifest.update(key, {
+            "url": path,
+            "size": len(content),
+            "sha256": hashlib.sha256(content).hexdigest(),
+            "etag": r.headers.get("ETag"),
+            "last_modified": r.headers.get("Last-Modified")
+        })
+    # seconds includes waiting for the rate limiter.
+    instrument.record(instrument.chapter_key(version, title, chapter),
+        seconds=time.perf_counter() - start,
+        bytes_downloaded=len(r.content),
+        bytes_written=len(content))
+    return "downloaded"
+
+def download_chapters(s, limiter, jobs, workers=1, manifests=None, revalidate=False, parser=None, failed=None):
+    """Download every (version, title, chapter) in jobs.
+
+    With one worker the chapters are fetched in order on the calling thread.
+    Otherwise they are spread across a thread pool that shares the session
+    (and its retry/backoff adapters) and the rate limiter. Jobs from several
+    versions can be mixed in one call. manifests maps a version to its
+    Manifest.
+
+    Returns a count of each download_chapter result. Chapters that failed
+    ("{version} {title} {chapter}") are added to the failed list, if given.
+    A failed chapter's html and manifest entry are left as they were.
+    """
+    manifests = manifests or {}
+    results = {}
+    try:
+        with tqdm(total=len(jobs), unit="chapter") as progress:
+            if workers <= 1:
+                for version, title, chapter in jobs:
+                    try:
+                        result = download_chapter(s, limiter, version, title, chapter, manifests.get(version), revalidate, parser)
+                        results[result] = results.get(result, 0) + 1
+                    except Exception as e:
+                        tqdm.write("Failed to download {} {} {}: {}".format(version, title, chapter, e))
+                        results["failed"] = results.get("failed", 0) + 1
+                        if failed is not None:
+                            failed.append("{} {} {}".format(version, title, chapter))
+                    progress.update()
+                return results
+
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = {
+                    executor.submit(download_chapter, s, limiter, version, title, chapter, manifests.get(version), revalidate, parser): (version, title, chapter)
+                    for version, title, chapter in jobs
+                }
+                for future in as_completed(futures):
+                    try:
+                        result = future.result()
+                        results[result] = results.get(result, 0) + 1
+                    except Exception as e:
+                        tqdm.write("Failed to download {} {} {}: {}".format(*futures[future], e))
+                        results["failed"] = results.get("failed", 0) + 1
+                        if failed is not None:
+                            failed.append("{} {} {}".format(*futures[future]))
+                    progress.update()
+            return results
+    finally:
+        # Always save what was downloaded so the next run can pick up
+        # where this one stopped.
+        for manifest in manifests.values():
+            manifest.save()
+
+def write_book_info(book_info):
+    output_path = Path("books", "input", book_info["version"])
+    output_path.mkdir(parents=True, exist_ok=True)
+    with open(Path(output_path, "chapters_{}.json".format(book_info["version"])), "w") as f:
+        f.write(json.dumps(book_info, indent=4))
+
+def add_arguments(parser):
+    parser.add_argument("-v", "--versions", nargs = "+", help = "Versions to download. Each must be the default version or listed under versions in config.json. If ommited the default version in config.json is downloaded.", required=False)
+    parser.add_argument("-j", "--jobs", type=int, default=1, help = "Number of chapters to download at the same time. Defaults to 1.", required=False)
+    parser.add_argument("-r", "--rate", type=float, default=2.0, help = "Maximum requests per second sent to BibleGateway. 0 disables the limit. Defaults to 2.", required=False)
+    parser.add_argument("--revalidate", action="store_true", help = "Send conditional requests for chapters that are already downloaded instead of skipping them.", required=False)
+    parser.add_argument("--force", action="store_true", help = "Ignore the manifest and download every chapter again.", required=False)
+    parser.add_argument("-p", "--parser", choices=PARSERS, help = "html parser used by BeautifulSoup. The saved html is serialized by this parser so changing it changes the files. Defaults to html.parser.", required=False)
+    instrument.add_arguments(parser)
+
+def main(args):
     # Most Bible versions are copywritten. You should comply with the Copyright
-    # notice on the version's page on Bible Gateway. 
+    # notice on the version's page on Bible Gateway.
 
-    # Bible Gateway has a page that lists available books and chapters in 
+    # Bible Gateway has a page that lists available books and chapters in
     # those books. Parse this page instead of hardcoding books and number
-    # of chapters. 
+    # of chapters.
     # The human_name entry in config.json file needs to exactly match the
     # URL entry for a version listed on https://www.biblegateway.com/versions/.
     # The version needs to match the version abbreviation.
@@ -36,94 +347,44 @@ if __name__ == '__main__':
     # and pythonbible. Thus, the script will only download books in the Protestant canon (for which
     # pythonbible is well covered).
 
-    book_url = "https://www.biblegateway.com/versions/{human_name}-{version}-Bible/#booklist".format(
-        human_name=config["human_name"],
-        version=config["version"]
-    )
+    # All versions share one session (one connection pool), one rate limiter
+    # and one pool of download threads.
+    s = get_session(args["jobs"])
+    limiter = RateLimiter(args["rate"], burst=args["jobs"])
 
-    s = requests.Session()
-    retries = Retry(total=5, backoff_factor=1, status_forcelist=[ 502, 503, 504 ])
-    s.mount('http://', HTTPAdapter(max_retries=retries))
-    s.mount('https://', HTTPAdapter(max_retries=retries))
+    try:
+        configs = load_configs(args["versions"])
+        html_parser = get_parser(args["parser"])
 
-    book_info = {
-        "version": config["version"],
-        "books": []
-    }
+        book_infos = []
+        jobs = []
+        manifests = {}
+        for config in configs:
+            config["parser"] = html_parser
+            with instrument.stage("book list"):
+                book_info, version_jobs = get_chapter_jobs(s, config)
+            book_infos.append(book_info)
+            jobs.extend((config["version"], title, chapter) for title, chapter in version_jobs)
+
+            manifests[config["version"]] = Manifest(config["version"])
+            if args["force"]:
+                manifests[config["version"]].entries = {}
+
+        with instrument.stage("download"):
+            failed = []
+            results = download_chapters(s, limiter, jobs, workers=args["jobs"], manifests=manifests, revalidate=args["revalidate"], parser=html_parser, failed=failed)
+        print(", ".join("{} {}".format(count, result) for result, count in sorted(results.items())))
+        if failed:
+            print("{} chapters failed, run again to retry them: {}".format(len(failed), ", ".join(sorted(failed))))
+
+        for book_info in book_infos:
+            write_book_info(book_info)
 
-    try:
-        resp = s.get(book_url)
-        soup = BeautifulSoup(resp.text, "html.parser")
-        stop = False
-
-        for row in tqdm(soup.find("table", {"class", "chapterlinks"}).find_all("tr"), unit="Book"):
-            count = 1
-            ref = None
-            links = row.find_all("a")
-
-            # See notes about apocrypha.
-            if stop:
-                break
-            try:
-                found = {}
-                skip = False
-                for link in links:
-                    if stop:
-                        break
-                    if not skip:
-                        # Try to turn the href title into a book-chaper reference
-                        ref = bible.get_references(link.attrs["title"])
-                        if ref:
-                            # Only get the book of the Protestant canon (Genesis as 1 through Revelation as 66)
-                            if 1 <= ref[0].book.value <= 66:
-                                if bible.get_book_titles(ref[0].book):
-                                    title = bible.get_book_titles(ref[0].book).short_title
-                            else:
-                                tqdm.write("Skipping {}.".format(link.attrs["title"]))
-                                skip = True
-                                # Stop fetching books.
-                                stop = True
-                                continue
-                        else:
-                            tqdm.write("Couldn't get pythonbible ref for {}.".format(link.attrs["title"]))
-                            skip = True
-                            continue
-                        
-                        # Download the html
-                        chapter_path = path = "https://www.biblegateway.com/passage/?search={title}%20{chapter}&version={version}&interface=print".format(
-                            title=title,
-                            chapter=count,
-                            version=config["version"]
-                        )
-
-                        r = s.get(path)
-                        chapter_path = output_path = Path("books", "input", config["version"], "html")
-                        chapter_path.mkdir(parents=True, exist_ok=True)
-
-                        passage_soup = BeautifulSoup(r.text, "html.parser")
-                        passage = passage_soup.find(class_="passage-col")
-
-                        with open(Path(chapter_path, "{}-{}.html".format(
-                            title,
-                            count
-                        )), "w", encoding='utf-8') as f:
-                            f.write(str(passage))
-                    
-                    count = count + 1
-                if not stop:
-                    found = {
-                        "name": title,
-                        "chapters": count - 1
-                    }
-                    book_info["books"].append(found)
-            except bible.errors.InvalidChapterError as e:
-                tqdm.write("WARNING: " + str(e))
-                continue
-
-        output_path = Path("books", "input", config["version"])
-        output_path.mkdir(parents=True, exist_ok=True)
-        with open(Path(output_path, "chapters_{}.json".format(config["version"])), "w") as f:
-            f.write(json.dumps(book_info, indent=4))
-        
     except Exception as e:
         traceback.print_exc()
+
+if __name__ == '__main__':
+    arg_desc = "Command line switches are optional."
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description = arg_desc)
+    add_arguments(parser)
+    instrument.run(main, vars(parser.parse_args()), "download")
@@ -1,15 +1,29 @@
 import argparse
 import json
+import os
+import re
 import sys
+import time
 import traceback
 
 import pythonbible as bible
 
 from pathlib import Path
+from itertools import groupby
+from json.encoder import encode_basestring_ascii as quote
 from operator import itemgetter
 
 from tqdm import tqdm
 
+import bible_cache
+import instrument
+from build_state import code_fingerprint, digest
+from crossref_index import CROSSREF, CrossrefIndex, index_folder
+from model import decode_verses
+from search import load_selection
+from store import VerseStore, store_path
+from versions import load_configs
+
 class Book:
     def __init__ (self, bookinfo, version):
         self.book = bookinfo["name"]
@@ -23,355 +37,1044 @@ class Book:
 def normalize_name(input):
     return input.replace(" ", "-").replace(":", "-")
 
-if __name__ == '__main__':
-    try:
-        arg_desc = "Command line switches are optional."
-        parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description = arg_desc)
-
-        parser.add_argument("-o", "--output", help = "Output file name. Will be saved in output/{version}/tif/{input}.json). If ommited will default to {version}.json.", required=False)
-        parser.add_argument("-b", "--books", nargs = "+", help = "Books groups to include. See README.md for valid options.", required=False)
-
-        args = vars(parser.parse_args())
-
-        # TODO fix the ref that looks like 'Job 38:26-Job 38:28'
-        # TODO fix the ref that looks like '1 Chronicles 1:5-1 Chronicles 1:7'
-
-        # Set these to None to run all books, or chapter, or verses.
-        debug_book = None # or something like "James"
-        debug_chapter = None # or a particular chapter integer
-        debug_verse = None # or a particular verse integer
-
-        with open(Path("config.json"), "r") as f:
-            config = json.loads(f.read())
-
-        with open(Path("books", "input", config["version"], "chapters_{}.json".format(config["version"])), 'r') as f:
-            books = json.loads(f.read())
-
-        # For output
-        tif_folder = Path("books", "output", config["version"], "tif")
-        tif_folder.mkdir(parents=True, exist_ok=True)
-
-        tif_object = {
-            "version": "TanaIntermediateFile V0.1",
-            "attributes": [
-                {
-                    "name": "Version",
-                    "dataType": "any"
-                },
-                {
-                    "name": "Book (abbr)",
-                    "dataType": "any"
-                },
-                {
-                    "name": "Book",
-                    "dataType": "any"
-                },
-                {
-                    "name": "Chapter",
-                    "dataType": "any"
-                },
-                {
-                    "name": "Starting Verse",
-                    "dataType": "any"
-                },
-                {
-                    "name": "Ending Verse",
-                    "dataType": "any"
-                },
-                {
-                    "name": "Footnotes",
-                    "dataType": "any"
-                },
-                {
-                    "name": "Cross References",
-                    "dataType": "any"
-                }
-            ],
-            "nodes": [],
-            "supertags": [
-                {
-                    "uid": "bibleverse",
-                    "name": "verse"
-                }
-            ]
+# Everything in a Tana Import Format file except the nodes.
+TIF_HEADER = {
+    "version": "TanaIntermediateFile V0.1",
+    "attributes": [
+        {
+            "name": "Version",
+            "dataType": "any"
+        },
+        {
+            "name": "Book (abbr)",
+            "dataType": "any"
+        },
+        {
+            "name": "Book",
+            "dataType": "any"
+        },
+        {
+            "name": "Chapter",
+            "dataType": "any"
+        },
+        {
+            "name": "Starting Verse",
+            "dataType": "any"
+        },
+        {
+            "name": "Ending Verse",
+            "dataType": "any"
+        },
+        {
+            "name": "Footnotes",
+            "dataType": "any"
+        },
+        {
+            "name": "Cross References",
+            "dataType": "any"
+        }
+    ],
+    "nodes": [],
+    "supertags": [
+        {
+            "uid": "bibleverse",
+            "name": "verse"
+        }
+    ]
+}
+
+class TifWriter:
+    """Write a Tana Import Format file one node at a time.
+
+    Only one node is held in memory at a time. The file is the same as
+    json.dumps(tif_object, indent=2) of the whole tif object would produce
+    (minified with a compact serializer).
+    Nothing is written until the first node arrives, and the file is built
+    under a temporary name so a failed run doesn't leave half a file behind.
+    Verses are written with serializer, a VerseSerializer. If uid_map is
+    given the short uid codes are saved there once the file is written,
+    see write_uid_map.
+    """
+    def __init__(self, path, header=TIF_HEADER, serializer=None, uid_map=None):
+        self.path = Path(path)
+        self.serializer = serializer or VERSE_SERIALIZER
+        self.uid_map = uid_map
+        self.tmp = self.path.with_suffix(".tmp")
+        self.nodes = 0
+        self.bytes = 0
+        self.f = None
+        # Split the header around the empty nodes list.
+        text = json.dumps(dict(header, nodes=[]), indent=self.serializer.indent, separators=self.serializer.separators)
+        self.prefix, self.suffix = text.split(self.serializer.empty_nodes)
+        self.prefix += self.serializer.empty_nodes[:-1]
+        self.suffix = self.serializer.nodes_end + self.suffix
+
+    @staticmethod
+    def serialize(node):
+        # Nodes sit two levels deep in the tif object.
+        return "\n    " + json.dumps(node, indent=2).replace("\n", "\n    ")
+
+    def write_node(self, node):
+        self.write_serialized(self.serializer.dumps(node))
+
+    def write_verse(self, book_name, verse, index=None):
+        """Write the verse_node of a verse without building it, see VerseSerializer."""
+        text, summary = self.serializer.serialize(book_name, verse, index, summary=False)
+        self.write_serialized(text)
+
+    def write_serialized(self, text, summary=None):
+        """Write a node that has already been through serialize.
+
+        summary (see node_summary) is only needed by ShardedTifWriter.
+        """
+        if self.f is None:
+            self.f = open(self.tmp, "w")
+            self.f.write(self.prefix)
+            self.bytes = len(self.prefix) + len(self.suffix)
+        else:
+            self.f.write(",")
+            self.bytes += 1
+        self.f.write(text)
+        self.bytes += len(text)
+        self.nodes += 1
+
+    def close(self):
+        if self.f is None:
+            return
+        self.f.write(self.suffix)
+        self.f.close()
+        self.f = None
+        os.replace(self.tmp, self.path)
+        if self.uid_map:
+            write_uid_map(self.uid_map)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        elif self.f is not None:
+            self.f.close()
+            self.tmp.unlink()
+
+def walk_nodes(node):
+    """Yield a node and every node nested in its children."""
+    yield node
+    for child in node.get("children", []):
+        yield from walk_nodes(child)
+
+def node_summary(node):
+    """The uids inside a top level node and the references it makes."""
+    summary = {"uid": node["uid"], "uids": [], "refs": []}
+    for n in walk_nodes(node):
+        summary["uids"].append(n["uid"])
+        for target in n.get("refs", []):
+            summary["refs"].append((n["uid"], target))
+    return summary
+
+class ShardedTifWriter:
+    """Split a Tana Import Format export into several smaller files.
+
+    Tana fails to import very large files, so nodes are written in order to
+    {name}-001.json, {name}-002.json, ... and a new file is started before
+    one would go over max_nodes (counting nested nodes) or max_bytes. A top
+    level node is never split across files. Every shard is a complete tif
+    file.
+
+    {name}-manifest.json lists each shard with its node counts, size, first
+    and last uid and every reference whose target is not in that shard.
+    The manifest also says which shard holds the target, or null if the
+    target wasn't exported, and which other shards each shard depends on.
+    Import the shards in order.
+
+    Shards are written in Bible order, not sorted so every shard comes after
+    the shards it refers to. Cross references point both ways (a verse and
+    the verse it refers to often refer to each other), so no order can do
+    that, and sorting would mean holding the whole export in memory.
+    References to a later shard resolve once that shard is imported.
+
+    If the export fails the shards already written are deleted, like
+    TifWriter deletes its half written file.
+    """
+    def __init__(self, folder, name, max_nodes=None, max_bytes=None, header=TIF_HEADER, serializer=None, uid_map=None):
+        self.folder = Path(folder)
+        self.serializer = serializer or VERSE_SERIALIZER
+        self.uid_map = uid_map
+        self.name = name
+        self.max_nodes = max_nodes
+        self.max_bytes = max_bytes
+        self.header = header
+        self.shards = []
+        self.writer = None
+        self.uids = None
+        self.refs = None
+        self.first = None
+        self.last = None
+        self.total_nodes = 0
+
+    def _start_shard(self):
+        self._close_shard()
+        path = Path(self.folder, "{}-{:03d}.json".format(self.name, len(self.shards) + 1))
+        self.writer = TifWriter(path, self.header, self.serializer)
+        self.total_nodes = 0
+        self.first = None
+        self.last = None
+        self.uids = []
+        self.refs = []
+        self.shards.append({"file": path.name})
+
+    def _close_shard(self):
+        if self.writer is None:
+            return
+        self.writer.close()
+        self.shards[-1].update({
+            "nodes": self.writer.nodes,
+            "total_nodes": self.total_nodes,
+            "bytes": self.writer.bytes,
+            "first": self.first,
+            "last": self.last,
+            "uids": self.uids,
+            "refs": self.refs
+        })
+        self.writer = None
+
+    def write_node(self, node):
+        self.write_serialized(self.serializer.dumps(node), node_summary(node))
+
+    def write_verse(self, book_name, verse, index=None):
+        self.write_serialized(*self.serializer.serialize(book_name, verse, index))
+
+    def write_serialized(self, text, summary):
+        nested = len(summary["uids"])
+
+        if self.writer is None:
+            self._start_shard()
+        elif self.writer.nodes > 0:
+            if self.max_nodes and self.total_nodes + nested > self.max_nodes:
+                self._start_shard()
+            elif self.max_bytes and self.writer.bytes + len(text) + 1 > self.max_bytes:
+                self._start_shard()
+
+        self.writer.write_serialized(text)
+        if self.first is None:
+            self.first = summary["uid"]
+        self.last = summary["uid"]
+        self.total_nodes += nested
+        self.uids.extend(summary["uids"])
+        self.refs.extend(summary["refs"])
+
+    def close(self):
+        self._close_shard()
+        if not self.shards:
+            return
+
+        shard_of = {}
+        for i, shard in enumerate(self.shards):
+            for uid in shard["uids"]:
+                shard_of[uid] = i
+
+        manifest = {"shards": []}
+        for i, shard in enumerate(self.shards):
+            uids = set(shard.pop("uids"))
+            external = []
+            for source, target in shard.pop("refs"):
+                if target not in uids:
+                    external.append({
+                        "from": source,
+                        "to": target,
+                        "shard": self.shards[shard_of[target]]["file"] if target in shard_of else None
+                    })
+            shard["external_refs"] = external
+            shard["depends_on"] = sorted({ref["shard"] for ref in external if ref["shard"] is not None})
+            manifest["shards"].append(shard)
+
+        with open(Path(self.folder, "{}-manifest.json".format(self.name)), "w") as f:
+            f.write(json.dumps(manifest, indent=2))
+        if self.uid_map:
+            write_uid_map(self.uid_map)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+            return
+        if self.writer is not None and self.writer.f is not None:
+            self.writer.__exit__(exc_type, exc, tb)
+        # Without the rest of the export (and a manifest) the finished shards
+        # can't be imported safely.
+        for shard in self.shards:
+            Path(self.folder, shard["file"]).unlink(missing_ok=True)
+        Path(self.folder, "{}-manifest.json".format(self.name)).unlink(missing_ok=True)
+
+def verse_skeleton(uid, name, book_name, chapter, verse_num, text, book_ref=None, chapter_ref=None):
+    """The node for a verse without its footnotes and cross references.
+
+    Every argument is a string. book_ref and chapter_ref are the uids of the
+    shared book and chapter nodes, see VerseSerializer. VerseSerializer
+    compiles its templates from this too, so keep the two in step by
+    changing the shape only here.
+    """
+    return {
+        "type": "node",
+        "uid": uid,
+        #"uid": "{}-{}-{}".format(normalize_name(o["book"]),bible.get_chapter_number(verse["verse_id"]),verse["verse"]),
+        "name": name,
+        "supertags": ["bibleverse"],
+        "children": [
+            {
+                "type": "field",
+                #"uid": "{}-{}-{}-book-abbr".format(normalize_name(o["book"]),bible.get_chapter_number(verse["verse_id"]),verse["verse"]),
+                "uid": "{}-book-abbr".format(uid),
+                "name": "Book (abbr)",
+                "children": [
+                    field_value("{}-book-abbr-val".format(uid), book_name, book_ref)
+                ]
+            },
+                            {
+                "type": "field",
+                "uid": "{}-book-".format(uid),
+                # "uid": "{}-{}-{}-book".format(normalize_name(o["book"]),bible.get_chapter_number(verse["verse_id"]),verse["verse"]),
+                "name": "Book",
+                "children": [
+                    field_value("{}-book-val".format(uid), book_name, book_ref)
+                ]
+            },
+                            {
+                "type": "field",
+                "uid": "{}-chapter".format(uid),
+                # "uid": "{}-{}-{}-chapter".format(normalize_name(o["book"]),bible.get_chapter_number(verse["verse_id"]),verse["verse"]),
+                "name": "Chapter",
+                "children": [
+                    field_value("{}-chapter-val".format(uid), chapter, chapter_ref)
+                ]
+            },
+                            {
+                "type": "field",
+                "uid": "{}-starting-verse".format(uid),
+                # "uid": "{}-{}-{}-starting-verse".format(normalize_name(o["book"]),bible.get_chapter_number(verse["verse_id"]),verse["verse"]),
+                "name": "Starting Verse",
+                "children": [
+                    {
+                        "type": "node",
+                        "uid": "{}-starting-verse-val".format(uid),
+                        # "uid": "{}-{}-{}-starting-verse-val".format(normalize_name(o["book"]),bible.get_chapter_number(verse["verse_id"]),verse["verse"]),
+                        "name": verse_num
+                    }
+                ]
+            },
+                            {
+                "type": "field",
+                "uid": "{}-ending_verse".format(uid),
+                # "uid": "{}-{}-{}-ending-verse".format(normalize_name(o["book"]),bible.get_chapter_number(verse["verse_id"]),verse["verse"]),
+                "name": "Ending Verse",
+                "children": [
+                    {
+                        "type": "node",
+                        "uid": "{}-ending-verse-val".format(uid),
+                        # "uid": "{}-{}-{}-ending-verse-val".format(normalize_name(o["book"]),bible.get_chapter_number(verse["verse_id"]),bible.get_verse_number(verse["verse_id"])),
+                        "name": verse_num
+                    }
+                ]
+            },
+            {
+                "type": "node",
+                "uid": "{}-text".format(uid),
+                # "uid": "{}-{}-{}-text".format(normalize_name(o["book"]),bible.get_chapter_number(verse["verse_id"]),verse["verse"]),
+                "name": text
+            }
+        ]
+    }
+
+def field_value(uid, name, ref=None):
+    """The value of a field, or a reference to the shared node ref when it is given."""
+    if ref is None:
+        return {
+            "type": "node",
+            "uid": uid,
+            "name": name
         }
+    return {
+        "type": "node",
+        "uid": uid,
+        "name": "[[{}]]".format(ref),
+        "refs": [ref]
+    }
+
+def value_node(uid, name, refs=None):
+    """A footnote or cross reference node. refs are the uids it links to."""
+    node = {
+        "type": "node",
+        "uid": uid,
+        "name": name
+    }
+    if refs is not None:
+        node["refs"] = refs
+    return node
+
+def footnotes_field(uid, children):
+    return {
+        "type": "field",
+        "uid": "{}-fn".format(uid),
+        "name": "Footnotes",
+        "children": children
+    }
 
-        max_keys = 0
-
-        # command line switch to only generate tana import files for certain Bible groups 
-        # (https://github.com/avendesora/pythonbible/blob/main/pythonbible/book_groups.py)
-        # The possible groups are:
-        # OLD_TESTAMENT_LAW
-        # OLD_TESTAMENT_HISTORY
-        # OLD_TESTAMENT_POETRY_WISDOM
-        # OLD_TESTAMENT_PROPHECY
-        # OLD_TESTAMENT_MAJOR_PROPHETS
-        # OLD_TESTAMENT_MINOR_PROPHETS
-        # NEW_TESTAMENT
-        # NEW_TESTAMENT_GOSPELS
-        # NEW_TESTAMENT_HISTORY
-        # NEW_TESTAMENT_EPISTLES
-        # NEW_TESTAMENT_PAUL_EPISTLES
-        # NEW_TESTAMENT_GENERAL_EPISTLES
-        # NEW_TESTAMENT_APOCALYPTIC
-        b = ()
+def crossrefs_field(uid, key, children):
+    # The cross references sit under one node named after the first key.
+    return {
+        "type": "field",
+        "uid": "{}-cr".format(uid),
+        "name": "Cross References",
+        "children": [
+            {
+                "type": "node",
+                "uid": "{}-cr-values".format(uid),
+                "name": key,
+                "children": children
+            }
+        ]
+    }
+
+def crossref_values(book_name, verse, index=None):
+    """Yield (number, name, refs) for the cross reference nodes of a verse.
+
+    number goes into the node's uid, refs is None for a cross reference that
+    isn't linked. When index (a CrossrefIndex) is given cross references are
+    linked from the index, which also links verse ranges, instead of being
+    parsed here.
+    """
+    # At the time of writing every verse parsed from the HTML for the NRSVUE
+    # only has one set of cross references.
+    # So, verse["crossrefs"] might look like 
+    # [{"A": "Psalm 8:3"}, {"A": "Isaiah 42:5"}]
+
+    # # Start with an empty key. In the NRSVUE the key is the capital letter at the end
+    # of the verse, it denotes a cross reference.
+    # Get the first element's key
+    key = verse.crossrefs[0].ref
+
+    # Each verse may have multiple cross references. Keep track of where we are in the count.
+    c_i = 0
+
+    for note_num, this_key in enumerate(verse.crossrefs):
+        # Initialize a new bible reference. This is what we're searching
+        # for in the cross reference.
+        bible_ref = None
+
+        # If the key doesn't match the last key fetched then update the key
+        # and print info. At least for the NRSVUE this shouldn't happen.
+        if this_key.ref != key:
+            if key != None:
+                    tqdm.write("New key in {} {}:{}".format(
+                    book_name,
+                    bible_cache.get_chapter_number(verse.verse_id),
+                    bible_cache.get_verse_number(verse.verse_id)
+                    )
+                )
+            key = this_key.ref
+            c_i += 1
+        if index:
+            targets = index.note_targets(verse.verse_id, CROSSREF, note_num)
+            if targets:
+                # Link to the first verse of each range.
+                yield c_i, "[{alias}]([[{uid}]])".format(
+                    alias=this_key.text,
+                    uid=targets[0][0]
+                ), ["{}".format(start) for start, end in targets]
+            else:
+                yield c_i, this_key.text, None
+            c_i += 1
+            continue
 
         try:
-            if args["books"]:
-                for this_input in args["books"]:
-                    b = b + bible.BookGroup[this_input].books
-        except KeyError as e:
-            print("Cound not find input book group.")
-            print(e)
+            bible_ref = bible_cache.get_references(this_key.text)
+        except ValueError as e:
+            tqdm.write("Problem with {} {}:{}. {}".format(
+                book_name,
+                bible_cache.get_chapter_number(verse.verse_id),
+                bible_cache.get_verse_number(verse.verse_id),
+                this_key.text)
+            )
+
+        # If bible_ref represents one verse from one chapter that will be formatted as a link
+        # to a node.
+        plain = True
+        if bible_ref and len(bible_ref) == 1:
+            if bible_ref[0].end_chapter == bible_ref[0].start_chapter and bible_ref[0].end_verse == bible_ref[0].start_verse:
+                # What is the target refernce (i.e. 1001001 for Genesis 1:1.)
+                target = bible_cache.convert_reference_to_verse_ids(bible_ref[0])
+                yield c_i, "[{alias}]([[{uid}]])".format(
+                    alias=this_key.text,
+                    uid=target[0]
+                ), ["{}".format(target[0])]
+                plain = False
+
+        if plain:
+            yield c_i, this_key.text, None
+
+        c_i += 1
+
+def verse_node(book_name, verse, index=None, shared_values=False, compact=False):
+    """Build the Tana node for one Verse from the parsed chapter json.
+
+    See crossref_values for index and VerseSerializer for shared_values and
+    compact. VerseSerializer writes the same node without building it.
+    """
+    chapter = bible_cache.get_chapter_number(verse.verse_id)
+    verse_num = bible_cache.get_verse_number(verse.verse_id)
+    uid = "{}".format(verse.verse_id)
+
+    book_ref = None
+    chapter_ref = None
+    if shared_values:
+        book_ref = book_uid(verse.verse_id // 1000000)
+        chapter_ref = chapter_uid(verse.verse_id // 1000000, chapter)
+
+    node = verse_skeleton(uid, "{} {}:{}".format(book_name, chapter, verse_num), book_name, str(chapter), str(verse_num), verse.text, book_ref, chapter_ref)
+
+    # For this verse, get all the footnotes that were found when parsing the html.
+    children = []
+    for f_i, footnote in enumerate(verse.footnotes):
+        children.append(value_node("{}-fn-values-{}".format(uid, f_i), "{}: {}".format(footnote.ref, footnote.text)))
+    if children or not compact:
+        node["children"].append(footnotes_field(uid, children))
+
+    # If there are cross references...
+    if len(verse.crossrefs) > 0:
+        children = []
+        for c_i, name, refs in crossref_values(book_name, verse, index):
+            children.append(value_node("{}-cr-values-{}".format(uid, c_i), name, refs))
+        node["children"].append(crossrefs_field(uid, verse.crossrefs[0].ref, children))
+
+    if compact:
+        shorten_uids(node)
+    return node
+
+def book_uid(book_num):
+    return "book-{}".format(book_num)
+
+def chapter_uid(book_num, chapter):
+    return "book-{}-chapter-{}".format(book_num, chapter)
+
+def book_node(book_name, book_num, chapters):
+    """The node shared by every verse of a book with shared_values, with a node for each chapter."""
+    return {
+        "type": "node",
+        "uid": book_uid(book_num),
+        "name": book_name,
+        "children": [
+            {
+                "type": "node",
+                "uid": chapter_uid(book_num, chapter),
+                "name": str(chapter)
+            }
+            for chapter in chapters
+        ]
+    }
+
+# Short uids for the compact profile. The verse uid (the verse id) stays as
+# it is, so references to a verse work in either profile, and the suffix of
+# each node inside a verse becomes a code of one or two letters, i.e.
+# 1001001-starting-verse-val is 1001001sv and 1001001-fn-values-2 is
+# 1001001fv2. expand_uid turns them back, and write_uid_map saves the codes
+# next to a compact export.
+SHORT_SUFFIXES = {
+    "-book-abbr": "a",
+    "-book-abbr-val": "av",
+    "-book-": "b",
+    "-book-val": "bv",
+    "-chapter": "c",
+    "-chapter-val": "cv",
+    "-starting-verse": "s",
+    "-starting-verse-val": "sv",
+    "-ending_verse": "e",
+    "-ending-verse-val": "ev",
+    "-text": "t",
+    "-fn": "f",
+    "-cr": "r",
+    "-cr-values": "rv"
+}
+# Suffixes followed by the number of the footnote or cross reference.
+NUMBERED_SHORT_SUFFIXES = {
+    "-fn-values-": "fv",
+    "-cr-values-": "rv"
+}
+LONG_SUFFIXES = {short: long for long, short in SHORT_SUFFIXES.items()}
+NUMBERED_LONG_SUFFIXES = {short: long for long, short in NUMBERED_SHORT_SUFFIXES.items()}
+
+LONG_UID = re.compile(r"(\d+|@id@)(-.*?)(\d+|@number@)?$")
+SHORT_UID = re.compile(r"(\d+)([a-z]+)(\d*)$")
+
+def short_uid(uid):
+    """The compact uid for a uid, uids that aren't inside a verse don't change."""
+    m = LONG_UID.match(uid)
+    if not m:
+        return uid
+    verse_uid, suffix, number = m.groups()
+    if number is None and suffix in SHORT_SUFFIXES:
+        return verse_uid + SHORT_SUFFIXES[suffix]
+    if number is not None and suffix in NUMBERED_SHORT_SUFFIXES:
+        return verse_uid + NUMBERED_SHORT_SUFFIXES[suffix] + number
+    return uid
+
+def expand_uid(uid):
+    """The uid a node from a compact export has in the default profile."""
+    m = SHORT_UID.match(uid)
+    if not m:
+        return uid
+    verse_uid, code, number = m.groups()
+    if number:
+        return verse_uid + NUMBERED_LONG_SUFFIXES[code] + number
+    return verse_uid + LONG_SUFFIXES[code]
 
+def shorten_uids(node):
+    # Some children of the sample nodes are placeholders, see VerseSerializer.
+    if isinstance(node, dict):
+        node["uid"] = short_uid(node["uid"])
+        for child in node.get("children", []):
+            shorten_uids(child)
+    return node
+
+def write_uid_map(path):
+    """Save the short uid codes, see SHORT_SUFFIXES."""
+    with open(path, "w", encoding='utf-8') as f:
+        f.write(json.dumps({"suffixes": LONG_SUFFIXES, "numbered": NUMBERED_LONG_SUFFIXES}, indent=2))
+
+# verse_node builds a dozen dicts for every verse and json.dumps walks them
+# again to write it. Every verse node has the same shape, so the shape is
+# serialized once into str.format templates, with placeholders where the
+# values go, and VerseSerializer only escapes and fills in the values.
+#
+# In the sample nodes "@@name@@" is replaced by a whole json value (an
+# escaped string or a list of nodes) and @name@ inside a string by text that
+# never needs escaping (verse ids and numbers).
+PLACEHOLDER = re.compile(r'"@@(\w+)@@"|@(\w+)@')
+
+def compile_placeholders(text):
+    return PLACEHOLDER.sub(lambda m: "{" + (m.group(1) or m.group(2)) + "}", text)
+
+class VerseSerializer:
+    """Write verse nodes from templates compiled once, see compile.
+
+    serialize(book_name, verse) is the same as TifWriter.serialize(verse_node(book_name, verse)).
+
+    With shared_values the values of the Book (abbr), Book and Chapter fields
+    of a verse are references to the node of the book and the chapter (see
+    book_node), which has to be written to the same export. A field value in
+    the Tana Import Format is always a child node, so every verse still has
+    one for each field, and the book and chapter nodes come on top. The
+    references are also longer than the values they replace (about 12% more
+    bytes for the ASV).
+
+    compact is a smaller profile for large imports: the file is minified,
+    the nodes inside a verse get short uids (see short_uid) and a verse
+    without footnotes has no Footnotes field.
+    """
+    def __init__(self, shared_values=False, compact=False):
+        self.shared_values = shared_values
+        self.compact = compact
+        # Keeps the saved nodes of ChapterCache apart.
+        self.name = "-".join(name for name, used in (("shared", shared_values), ("compact", compact)) if used) or "default"
+
+        # How TifWriter writes the rest of the file.
+        if compact:
+            self.indent = None
+            self.separators = (",", ":")
+            self.empty_nodes = '"nodes":[]'
+            self.nodes_end = "]"
+            self.node_start = ""
+        else:
+            self.indent = 2
+            self.separators = None
+            self.empty_nodes = '"nodes": []'
+            self.nodes_end = "\n  ]"
+            self.node_start = "\n    "
+
+        # Top level nodes are two levels deep (see TifWriter.serialize), their
+        # children four, the footnotes six and the cross references eight.
+        if shared_values:
+            skeleton = verse_skeleton("@id@", "@@name@@", "@@book@@", "@chapter@", "@verse@", "@@text@@",
+                book_uid("@book_num@"), chapter_uid("@book_num@", "@chapter@"))
+        else:
+            skeleton = verse_skeleton("@id@", "@@name@@", "@@book@@", "@chapter@", "@verse@", "@@text@@")
+        self.uid = short_uid if compact else str
+        if compact:
+            shorten_uids(skeleton)
+        nodes = list(walk_nodes(skeleton))
+        self.uid_suffixes = [n["uid"].replace("@id@", "") for n in nodes]
+        self.skeleton_refs = [(compile_placeholders(n["uid"]), compile_placeholders(target)) for n in nodes for target in n.get("refs", [])]
+        # Without any fields (compact leaves out empty ones).
+        self.bare_verse_template = self.node_start + self.compile(skeleton, 2)
+        skeleton["children"].append("@@fields@@")
+        self.verse_template = self.node_start + self.compile(skeleton, 2)
+
+        self.footnotes_template = self.compile(footnotes_field("@id@", ["@@notes@@"]), 4)
+        self.no_footnotes_template = self.compile(footnotes_field("@id@", []), 4)
+        self.footnote_template = self.compile(value_node("@id@-fn-values-@number@", "@@name@@"), 6)
+        self.crossrefs_template = self.compile(crossrefs_field("@id@", "@@key@@", ["@@notes@@"]), 4)
+        self.crossref_template = self.compile(value_node("@id@-cr-values-@number@", "@@name@@"), 8)
+        self.linked_crossref_template = self.compile(value_node("@id@-cr-values-@number@", "@@name@@", ["@@refs@@"]), 8)
+        self.field_separator = self.separator(4)
+        self.footnote_separator = self.separator(6)
+        self.crossref_separator = self.separator(8)
+        self.ref_separator = self.separator(10)
+
+        # The uids node_summary finds in the footnotes and cross references.
+        self.footnotes_uid = compile_placeholders(self.uid("@id@-fn"))
+        self.footnote_uid = compile_placeholders(self.uid("@id@-fn-values-@number@"))
+        self.crossrefs_uid = compile_placeholders(self.uid("@id@-cr"))
+        self.crossref_values_uid = compile_placeholders(self.uid("@id@-cr-values"))
+        self.crossref_uid = compile_placeholders(self.uid("@id@-cr-values-@number@"))
+
+    def compile(self, node, depth):
+        """A str.format template for node when it is depth levels (of two spaces) deep in a tif file."""
+        if self.compact:
+            text = json.dumps(shorten_uids(node), separators=self.separators)
+        else:
+            text = json.dumps(node, indent=2).replace("\n", "\n" + "  " * depth)
+        text = text.replace("{", "{{").replace("}", "}}")
+        return compile_placeholders(text)
+
+    def separator(self, depth):
+        """What goes between the items of a list depth levels deep."""
+        if self.compact:
+            return ","
+        return ",\n" + "  " * depth
+
+    def dumps(self, node):
+        """Serialize any top level node the way this profile writes verses."""
+        if self.compact:
+            return json.dumps(node, separators=self.separators)
+        return TifWriter.serialize(node)
+
+    def serialize(self, book_name, verse, index=None, summary=True):
+        """Return (serialized node, node_summary(node)) for the verse_node of a verse.
+
+        With summary=False the summary (only needed by ShardedTifWriter and
+        ChapterCache) is None.
+        """
+        chapter = bible_cache.get_chapter_number(verse.verse_id)
+        verse_num = bible_cache.get_verse_number(verse.verse_id)
+        book_num = verse.verse_id // 1000000
+        uid = "{}".format(verse.verse_id)
+
+        fields = []
+        if verse.footnotes:
+            notes = self.footnote_separator.join([
+                self.footnote_template.format(id=uid, number=f_i, name=quote("{}: {}".format(footnote.ref, footnote.text)))
+                for f_i, footnote in enumerate(verse.footnotes)
+            ])
+            fields.append(self.footnotes_template.format(id=uid, notes=notes))
+        elif not self.compact:
+            fields.append(self.no_footnotes_template.format(id=uid))
+
+        links = []
+        if verse.crossrefs:
+            links = list(crossref_values(book_name, verse, index))
+            notes = []
+            for c_i, name, refs in links:
+                if refs is None:
+                    notes.append(self.crossref_template.format(id=uid, number=c_i, name=quote(name)))
+                else:
+                    notes.append(self.linked_crossref_template.format(id=uid, number=c_i, name=quote(name),
+                        refs=self.ref_separator.join([quote(ref) for ref in refs])))
+            fields.append(self.crossrefs_template.format(id=uid, key=quote(verse.crossrefs[0].ref), notes=self.crossref_separator.join(notes)))
+
+        text = (self.verse_template if fields else self.bare_verse_template).format(
+            id=uid,
+            name=quote("{} {}:{}".format(book_name, chapter, verse_num)),
+            book=quote(book_name),
+            book_num=book_num,
+            chapter=chapter,
+            verse=verse_num,
+            text=quote(verse.text),
+            fields=self.field_separator.join(fields)
+        )
+        if not summary:
+            return text, None
+
+        # The same uids and refs, in the same order, as node_summary.
+        uids = [uid + suffix for suffix in self.uid_suffixes]
+        if verse.footnotes or not self.compact:
+            uids.append(self.footnotes_uid.format(id=uid))
+        uids.extend([self.footnote_uid.format(id=uid, number=f_i) for f_i in range(len(verse.footnotes))])
+        refs = [(source.format(id=uid), target.format(book_num=book_num, chapter=chapter)) for source, target in self.skeleton_refs]
+        if links:
+            uids.append(self.crossrefs_uid.format(id=uid))
+            uids.append(self.crossref_values_uid.format(id=uid))
+            for c_i, name, targets in links:
+                value_uid = self.crossref_uid.format(id=uid, number=c_i)
+                uids.append(value_uid)
+                for target in targets or ():
+                    refs.append((value_uid, target))
+        return text, {"uid": uid, "uids": uids, "refs": refs}
+
+VERSE_SERIALIZER = VerseSerializer()
+
+def serialize_verse(book_name, verse, index=None, summary=True):
+    """VerseSerializer.serialize with the default profile."""
+    return VERSE_SERIALIZER.serialize(book_name, verse, index, summary)
+
+def read_chapters(config, this_book, store=None):
+    """Yield (chapter, verses) for the parsed chapters of a book in order.
+
+    Verses come from the chapter json files written by parse.py or, when
+    store is a VerseStore, from the verse store with one query per book.
+    Either way they are model.Verse objects.
+    """
+    if store:
+        book_num = bible_cache.get_references(this_book.book)[0].book.value
+        rows = store.read_book(book_num, 1, this_book.chapters - 1)
+        for chapter_num, group in groupby(tqdm(rows, unit="verse"), key=itemgetter(0)):
+            yield chapter_num, [verse for _, verse in group]
+        return
+
+    for chapter_num in tqdm(range(1, this_book.chapters), initial=1, unit="verse", total=this_book.chapters):
+        start = time.perf_counter()
+        with open(Path("books", "output", config["version"], config["output_format"], "{}-{}.json".format(this_book.book, chapter_num)), "rb") as f:
+            verses = decode_verses(f.read())
+            if instrument.enabled():
+                instrument.record(instrument.chapter_key(config["version"], this_book.book, chapter_num),
+                    read_seconds=time.perf_counter() - start,
+                    bytes_read=os.fstat(f.fileno()).st_size)
+
+        yield chapter_num, verses
+
+# Source files whose changes mean every cached chapter has to be rebuilt.
+GENERATE_SOURCES = ["generate_tif.py", "bible_cache.py", "verse_table.py", "mapped_arrays.py", "model.py", "crossref_index.py"]
+
+class ChapterCache:
+    """The serialized nodes generated from each chapter in earlier runs.
+
+    Saved in books/output/{version}/cache/tif/{Book}-{chapter}.json with a
+    fingerprint of the chapter's verses and the code that turned them into
+    nodes. When neither changed the saved nodes are written to the export
+    as they are instead of being built and serialized again. With a
+    CrossrefIndex every chapter is rebuilt when the index changes. The nodes
+    of each VerseSerializer are saved separately. Only building the nodes
+    is skipped, the export is still written out in full.
+    """
+    def __init__(self, version, index=None, serializer=None):
+        self.serializer = serializer or VERSE_SERIALIZER
+        self.folder = Path("books", "output", version, "cache", "tif", self.serializer.name)
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.index = index
+        self.code = code_fingerprint(GENERATE_SOURCES)
+        if index:
+            self.code = digest(self.code, index.fingerprint)
+        self.hits = 0
+        self.misses = 0
+
+    def nodes(self, book_name, chapter_num, verses):
+        """Return [(serialized node, node summary), ...] for a chapter."""
+        path = Path(self.folder, "{}-{}.json".format(book_name, chapter_num))
+        fingerprint = digest(book_name, json.dumps([verse.to_dict() for verse in verses], sort_keys=True), self.code)
+
+        if path.exists():
+            with open(path, "r", encoding='utf-8') as f:
+                cached = json.loads(f.read())
+            if cached["fingerprint"] == fingerprint:
+                self.hits += 1
+                return cached["nodes"]
+
+        self.misses += 1
+        nodes = []
+        for verse in verses:
+            nodes.append(self.serializer.serialize(book_name, verse, self.index))
+        with open(path, "w", encoding='utf-8') as f:
+            f.write(json.dumps({"fingerprint": fingerprint, "nodes": nodes}))
+        return nodes
+
+def export_name(config, output=None):
+    """(folder, file name without .json) of an export."""
+    # For output
+    tif_folder = Path("books", "output", config["version"], "tif")
+    tif_folder.mkdir(parents=True, exist_ok=True)
+
+    if output:
+        if output[-5:] == ".json":
+            filename = output[:-5]
+        else:
+            filename = output
+    else:
+        filename = config["version"]
+    return tif_folder, filename
+
+def open_writer(config, output=None, max_nodes=None, max_bytes=None, serializer=None):
+    """The TifWriter (or ShardedTifWriter) for books/output/{version}/tif/{output}.json.
+
+    With a compact serializer the short uid codes are saved to
+    {output}-uids.json when the writer closes, if it wrote any nodes.
+    """
+    tif_folder, filename = export_name(config, output)
+    uid_map = None
+    if serializer and serializer.compact:
+        uid_map = Path(tif_folder, "{}-uids.json".format(filename))
+
+    if max_nodes or max_bytes:
+        return ShardedTifWriter(tif_folder, filename, max_nodes, max_bytes, serializer=serializer, uid_map=uid_map)
+    return TifWriter(Path(tif_folder, "{}.json".format(filename)), serializer=serializer, uid_map=uid_map)
+
+# command line switch to only generate tana import files for certain Bible groups 
+# (https://github.com/avendesora/pythonbible/blob/main/pythonbible/book_groups.py)
+# The possible groups are:
+# OLD_TESTAMENT_LAW
+# OLD_TESTAMENT_HISTORY
+# OLD_TESTAMENT_POETRY_WISDOM
+# OLD_TESTAMENT_PROPHECY
+# OLD_TESTAMENT_MAJOR_PROPHETS
+# OLD_TESTAMENT_MINOR_PROPHETS
+# NEW_TESTAMENT
+# NEW_TESTAMENT_GOSPELS
+# NEW_TESTAMENT_HISTORY
+# NEW_TESTAMENT_EPISTLES
+# NEW_TESTAMENT_PAUL_EPISTLES
+# NEW_TESTAMENT_GENERAL_EPISTLES
+# NEW_TESTAMENT_APOCALYPTIC
+def get_book_groups(names):
+    """The pythonbible books in the named book groups, None when names is None."""
+    if names is None:
+        return None
+
+    b = ()
+    try:
+        for this_input in names:
+            b = b + bible.BookGroup[this_input].books
+    except KeyError as e:
+        print("Cound not find input book group.")
+        print(e)
+    return b
+
+def generate_tif(config, b, output=None, max_nodes=None, max_bytes=None, use_store=False, incremental=False, use_index=False, verse_ids=None, shared_values=False, compact=False):
+    """Turn the parsed json for one version into a Tana Import Format file.
+
+    b is a tuple of pythonbible books to include, None includes every book.
+    The file is saved as books/output/{version}/tif/{output}.json, or
+    {version}.json when output is None. Nodes are written to the file as each
+    chapter is read so memory use doesn't grow with the number of books.
+
+    If max_nodes or max_bytes is set the export is split into shards, see
+    ShardedTifWriter. use_store reads the verses from the verse store saved
+    by parse.py -s instead of the chapter json files. incremental reuses the
+    nodes of unchanged chapters from the ChapterCache. use_index links the
+    cross references with the index saved by crossref_index.py. verse_ids
+    (i.e. the hits saved by search.py --select) limits the export to those
+    verses. shared_values writes one node for each book and chapter and
+    points the verses at them and compact writes the smaller compact
+    profile, see VerseSerializer.
+    """
+    # Refs that look like 'Job 38:26-Job 38:28' or '1 Chronicles 1:5-1 Chronicles 1:7'
+    # are only linked with use_index.
+
+    # Set these to None to run all books, or chapter, or verses.
+    debug_book = None # or something like "James"
+    debug_chapter = None # or a particular chapter integer
+    debug_verse = None # or a particular verse integer
+
+    with open(Path("books", "input", config["version"], "chapters_{}.json".format(config["version"])), 'r') as f:
+        books = json.loads(f.read())
+
+    serializer = VerseSerializer(shared_values, compact)
+    writer = open_writer(config, output, max_nodes, max_bytes, serializer)
+
+    index = CrossrefIndex(index_folder(config["version"])) if use_index else None
+
+    cache = ChapterCache(config["version"], index, serializer) if incremental else None
+
+    store = None
+    if use_store:
+        path = store_path(config["version"], config["output_format"])
+        if not path.exists():
+            raise FileNotFoundError("No verse store at {}. Run parse.py -s first.".format(path))
+        store = VerseStore(path)
+
+    selected = None
+    selected_books = None
+    if verse_ids is not None:
+        # Node uids are the verse ids as strings.
+        selected = {"{}".format(verse_id) for verse_id in verse_ids}
+        selected_books = {verse_id // 1000000 for verse_id in verse_ids}
+
+    with writer:
         for book in books["books"]:
-            
+
             this_book = Book(bookinfo=book, version=config["version"])
-            
-            if bible.get_references(this_book.book)[0].book in b or args["books"] is None:
+            bible_book = bible_cache.get_references(this_book.book)[0].book
+
+            if (b is None or bible_book in b) and (selected_books is None or bible_book.value in selected_books):
                 print(this_book.book)
 
-                for chapter_num in tqdm(range(1, this_book.chapters), initial=1, unit="verse", total=this_book.chapters):
-                    with open(Path("books", "output", config["version"], config["output_format"], "{}-{}.json".format(this_book.book, chapter_num)), "r") as f:
-                        o = json.load(f)
-                
-                    #for chapter_num in tqdm(range(1, this_book.chapters), initial=1, unit="verse", total=this_book.chapters):
-                    for verse in o["verses"]:
-                        node = {
-                            "type": "node",
-                            "uid": "{}".format(verse["verse_id"]),
-                            #"uid": "{}-{}-{}".format(normalize_name(o["book"]),bible.get_chapter_number(verse["verse_id"]),verse["verse"]),
-                            "name": "{} {}:{}".format(this_book.book,bible.get_chapter_number(verse["verse_id"]),bible.get_verse_number(verse["verse_id"])),
-                            "supertags": ["bibleverse"],
-                            "children": [
-                                {
-                                    "type": "field",
-                                    #"uid": "{}-{}-{}-book-abbr".format(normalize_name(o["book"]),bible.get_chapter_number(verse["verse_id"]),verse["verse"]),
-                                    "uid": "{}-book-abbr".format(verse["verse_id"]),
-                                    "name": "Book (abbr)",
-                                    "children": [
-                                        {
-                                            "type": "node",
-                                            "uid": "{}-book-abbr-val".format(verse["verse_id"]),
-                                            # "uid": "{}-{}-{}-book-abbr-val".format(normalize_name(o["book"]),bible.get_chapter_number(verse["verse_id"]),verse["verse"]),
-                                            "name":this_book.book
-                                        }
-                                    ]
-                                },
-                                                {
-                                    "type": "field",
-                                    "uid": "{}-book-".format(verse["verse_id"]),
-                                    # "uid": "{}-{}-{}-book".format(normalize_name(o["book"]),bible.get_chapter_number(verse["verse_id"]),verse["verse"]),
-                                    "name": "Book",
-                                    "children": [
-                                        {
-                                            "type": "node",
-                                            "uid": "{}-book-val".format(verse["verse_id"]),
-                                            # "uid": "{}-{}-{}-book-val".format(normalize_name(o["book"]),bible.get_chapter_number(verse["verse_id"]),verse["verse"]),
-                                            "name": this_book.book
-                                        }
-                                    ]
-                                },
-                                                {
-                                    "type": "field",
-                                    "uid": "{}-chapter".format(verse["verse_id"]),
-                                    # "uid": "{}-{}-{}-chapter".format(normalize_name(o["book"]),bible.get_chapter_number(verse["verse_id"]),verse["verse"]),
-                                    "name": "Chapter",
-                                    "children": [
-                                        {
-                                            "type": "node",
-                                            "uid": "{}-chapter-val".format(verse["verse_id"]),
-                                            # "uid": "{}-{}-{}-chapter-val".format(normalize_name(o["book"]),bible.get_chapter_number(verse["verse_id"]),verse["verse"]),
-                                            "name": str(bible.get_chapter_number(verse["verse_id"]))
-                                        }
-                                    ]
-                                },
-                                                {
-                                    "type": "field",
-                                    "uid": "{}-starting-verse".format(verse["verse_id"]),
-                                    # "uid": "{}-{}-{}-starting-verse".format(normalize_name(o["book"]),bible.get_chapter_number(verse["verse_id"]),verse["verse"]),
-                                    "name": "Starting Verse",
-                                    "children": [
-                                        {
-                                            "type": "node",
-                                            "uid": "{}-starting-verse-val".format(verse["verse_id"]),
-                                            # "uid": "{}-{}-{}-starting-verse-val".format(normalize_name(o["book"]),bible.get_chapter_number(verse["verse_id"]),verse["verse"]),
-                                            "name": str(bible.get_verse_number(verse["verse_id"]))
-                                        }
-                                    ]
-                                },
-                                                {
-                                    "type": "field",
-                                    "uid": "{}-ending_verse".format(verse["verse_id"]),
-                                    # "uid": "{}-{}-{}-ending-verse".format(normalize_name(o["book"]),bible.get_chapter_number(verse["verse_id"]),verse["verse"]),
-                                    "name": "Ending Verse",
-                                    "children": [
-                                        {
-                                            "type": "node",
-                                            "uid": "{}-ending-verse-val".format(verse["verse_id"]),
-                                            # "uid": "{}-{}-{}-ending-verse-val".format(normalize_name(o["book"]),bible.get_chapter_number(verse["verse_id"]),bible.get_verse_number(verse["verse_id"])),
-                                            "name": str(bible.get_verse_number(verse["verse_id"]))
-                                        }
-                                    ]
-                                },
-                                {
-                                    "type": "node",
-                                    "uid": "{}-text".format(verse["verse_id"]),
-                                    # "uid": "{}-{}-{}-text".format(normalize_name(o["book"]),bible.get_chapter_number(verse["verse_id"]),verse["verse"]),
-                                    "name": verse["text"]
-                                }
-                            ]
-                        }
-
-                        children = []
-
-                        f_i = 0
-
-                        # For this verse, get all the footnotes that were found when parsing the html.
-                        for footnote in verse["footnotes"]:
-                            if verse["clsstr"] == 'Gen-2-14':
-                                pass
-                            for verse_key in list(footnote.keys()):
-                                note = {
-                                    "type": "node",
-                                    "uid": "{}-fn-values-{}".format(verse["verse_id"], f_i),
-                                    # "uid": "{}-{}-{}-fn-values".format(normalize_name(o["book"]),bible.get_chapter_number(verse["verse_id"]),verse["verse"]),
-                                    "name": "{}: {}".format(verse_key, footnote[verse_key])
-                                }
-                                children.append(note)
-                                f_i += 1
-
-                        footnote_object = {
-                            "type": "field",
-                            "uid": "{}-fn".format(verse["verse_id"]),
-                            "name": "Footnotes",
-                            "children": children
-                        }
-
-                        node["children"].append(footnote_object)
-
-                        # The "name" in this case is the text of the node.
-                        cross_ref_name = ""
-
-                        # Each verse may have multiple cross references. Keep track of where we are in the count.
-                        c_i = 0
-
-                        refs = []
-
-                        # If there are cross references...
-                        if len(verse["crossrefs"]) > 0:
-
-                            # At the time of writing every verse parsed from the HTML for the NRSVUE
-                            # only has one set of cross references.
-                            # So, verse["crossrefs"] might look like 
-                            # [{"A": "Psalm 8:3"}, {"A": "Isaiah 42:5"}]
-
-                            # # Start with an empty key. In the NRSVUE the key is the capital letter at the end
-                            # of the verse, it denotes a cross reference.
-                            # Get the first element's key
-                            key = list(verse["crossrefs"][0].keys())[0]
-
-                            # Set up an object to hold information about this verse's footnotes.
-                            cross_refs_object = {
-                                "type": "node",
-                                "uid": "{}-cr-values".format(verse["verse_id"]),
-                                "name": key,
-                                "children": []
-                            }
-
-                            for this_key in verse["crossrefs"]:
-                                # Initialize a new bible reference. This is what we're searching
-                                # for in the cross reference.
-                                bible_ref = None
-
-                                # If the key doesn't match the last key fetched then update the key
-                                # and print info. At least for the NRSVUE this shouldn't happen.
-                                if list(this_key.keys())[0] != key:
-                                    if key != None:
-                                            tqdm.write("New key in {} {}:{}".format(
-                                            this_book.book,
-                                            bible.get_chapter_number(verse["verse_id"]),
-                                            bible.get_verse_number(verse["verse_id"])
-                                            )
-                                        )
-                                    key = list(this_key.keys())[0]
-                                    c_i += 1
-                                try:
-                                    bible_ref = bible.get_references(this_key[key])
-                                except ValueError as e:
-                                    tqdm.write("Problem with {} {}:{}. {}".format(
-                                        this_book.book,
-                                        bible.get_chapter_number(verse["verse_id"]),
-                                        bible.get_verse_number(verse["verse_id"]),
-                                        this_key[key])
-                                    )
-                                    # break
-                                    plain = True
-                                
-                                # If bible_ref represents one verse from one chapter that will be formatted as a link
-                                # to a node.
-                                if bible_ref:
-                                    if len(bible_ref) == 1:
-                                        if bible_ref[0].end_chapter == bible_ref[0].start_chapter and bible_ref[0].end_verse == bible_ref[0].start_verse:
-                                            # What is the target refernce (i.e. 1001001 for Genesis 1:1.)
-                                            target = bible.convert_reference_to_verse_ids(bible.get_references(this_key[key])[0])
-
-                                            name = "{}".format(key)
-
-                                            # Create a child for the actual cross reference elements.
-                                            cross_ref_node = {
-                                                "type": "node",
-                                                "uid": "{}-cr-values-{}".format(verse["verse_id"], c_i),
-                                                "name": "[{alias}]([[{uid}]])".format(
-                                                    alias=this_key[key],
-                                                    uid=target[0]
-                                                ),
-                                                "refs": ["{}".format(target[0])]
-                                            }
-                                            plain = False
-                                            cross_refs_object["children"].append(cross_ref_node)
-                                        else:
-                                                plain = True
-                                    else:
-                                        plain = True
-                                else:
-                                    plain = True
-                                
-                                if plain:
-                                    cross_ref_node = {
-                                        "type": "node",
-                                        "uid": "{}-cr-values-{}".format(verse["verse_id"], c_i),
-                                        "name": this_key[key]
-                                    }
-                                    cross_refs_object["children"].append(cross_ref_node)
-                                    
-                                c_i += 1
-                            
-                            # Final ouput. Contains nested objects.
-                            crossref_object = {
-                                "type": "field",
-                                "uid": "{}-cr".format(verse["verse_id"]),
-                                "name": "Cross References",
-                                "children": [cross_refs_object]
-                            }
-                            node["children"].append(crossref_object)
-                        tif_object["nodes"].append(node)
-
-        if len(tif_object["nodes"]) > 0:
-            if args["output"]:
-                if args["output"][-5:] == ".json":
-                    filename = args["output"][:-5]
-                else:
-                    filename = args["output"]
+                if shared_values:
+                    # Before the verses, so the book is in the shard (or
+                    # file) imported first.
+                    if selected is None:
+                        chapters = range(1, this_book.chapters)
+                    else:
+                        chapters = sorted({bible_cache.get_chapter_number(verse_id) for verse_id in verse_ids if verse_id // 1000000 == bible_book.value})
+                    writer.write_node(book_node(this_book.book, bible_book.value, chapters))
 
-                with open(Path(tif_folder, "{}.json".format(filename)), "w") as f:
-                    output = json.dumps(tif_object, indent=2)
-                    f.write(output)
-            else:
-                with open(Path(tif_folder, "{}.json".format(config["version"])), "w") as f:
-                    output = json.dumps(tif_object, indent=2)
-                    f.write(output)
+                for chapter_num, verses in read_chapters(config, this_book, store):
+                    start = time.perf_counter()
+                    if cache:
+                        for text, summary in cache.nodes(this_book.book, chapter_num, verses):
+                            if selected is None or summary["uid"] in selected:
+                                writer.write_serialized(text, summary)
+                    else:
+                        for verse in verses:
+                            if selected is None or "{}".format(verse.verse_id) in selected:
+                                writer.write_verse(this_book.book, verse, index)
+                    instrument.record(instrument.chapter_key(config["version"], this_book.book, chapter_num),
+                        seconds=time.perf_counter() - start,
+                        nodes=len(verses))
+
+    if instrument.enabled():
+        if isinstance(writer, ShardedTifWriter):
+            instrument.count("bytes_written", sum(shard["bytes"] for shard in writer.shards))
+        else:
+            instrument.count("bytes_written", writer.bytes)
+
+    if store:
+        store.close()
+    if index:
+        index.close()
+    if cache:
+        print("{} chapters reused, {} rebuilt.".format(cache.hits, cache.misses))
+
+def add_arguments(parser):
+    parser.add_argument("-o", "--output", help = "Output file name. Will be saved in output/{version}/tif/{input}.json). If ommited will default to {version}.json.", required=False)
+    parser.add_argument("-b", "--books", nargs = "+", help = "Books groups to include. See README.md for valid options.", required=False)
+    parser.add_argument("--max-nodes", type=int, help = "Split the output into files of at most this many nodes (counting nested nodes).", required=False)
+    parser.add_argument("--max-bytes", type=int, help = "Split the output into files of at most this many bytes.", required=False)
+    parser.add_argument("-s", "--store", action="store_true", help = "Read the verses from the verse store saved by parse.py -s instead of the chapter json files.", required=False)
+    parser.add_argument("-i", "--incremental", action="store_true", help = "Reuse the serialized nodes of chapters that haven't changed since the last incremental run. The export is still written in full.", required=False)
+    parser.add_argument("--verses", help = "Only export the verses in this json file, saved by search.py --select.", required=False)
+    parser.add_argument("--index", action="store_true", help = "Link cross references (including verse ranges) with the index saved by crossref_index.py.", required=False)
+    parser.add_argument("--shared-values", action="store_true", help = "Write one node for each book and chapter and point the Book (abbr), Book and Chapter fields of every verse at them instead of copying them into every verse. The verses link to their book and chapter, but the file gets bigger and the nodes don't get fewer, see README.md.", required=False)
+    parser.add_argument("--compact", action="store_true", help = "Write a smaller file: minified, with short uids inside each verse (the codes are saved to {output}-uids.json) and no empty Footnotes fields.", required=False)
+    parser.add_argument("--no-cache", action="store_true", help = "Don't load or save parsed references in books/output/{version}/cache.", required=False)
+    parser.add_argument("-v", "--versions", nargs = "+", help = "Versions to generate. Each must be the default version or listed under versions in config.json. If ommited the default version in config.json is generated.", required=False)
+    instrument.add_arguments(parser)
+
+def main(args):
+    try:
+        b = get_book_groups(args["books"])
+        verse_ids = load_selection(args["verses"]) if args["verses"] else None
+
+        for config in load_configs(args["versions"]):
+            if not args["no_cache"]:
+                bible_cache.load_disk_cache(config["version"])
+            with instrument.stage("generate {}".format(config["version"])):
+                generate_tif(config, b, args["output"], args["max_nodes"], args["max_bytes"], args["store"], args["incremental"], args["index"], verse_ids, args["shared_values"], args["compact"])
+        bible_cache.save_disk_cache()
 
     except Exception:
         traceback.print_exc()
-    
\ No newline at end of file
+
+if __name__ == '__main__':
+    arg_desc = "Command line switches are optional."
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description = arg_desc)
+    add_arguments(parser)
+    instrument.run(main, vars(parser.parse_args()), "generate_tif")
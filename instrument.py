@@ -0,0 +1,161 @@
+import cProfile
+import io
+import json
+import os
+import pstats
+import sys
+import time
+
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+
+import bible_cache
+
+# Opt-in timings for download.py, parse.py and generate_tif.py. Nothing is
+# recorded unless --report or --profile is passed. The report is a json file
+# with the time spent in each stage, per chapter (and per book) timings and
+# byte counts, parser versus formatting time and the reference cache hits.
+#
+# Like the reference cache, worker processes keep their own records and send
+# them back with pop_entries so the parent process can merge_entries them.
+
+_enabled = False
+_stages = {}
+_chapters = {}
+# Totals for the whole run that don't belong to a chapter.
+_counters = {}
+# The reference cache stats of every worker process, by pid.
+_cache = {}
+
+def enabled():
+    return _enabled
+
+def enable():
+    global _enabled
+    _enabled = True
+
+@contextmanager
+def stage(name):
+    """Add the time spent in the with block to a stage (i.e. "download")."""
+    if not _enabled:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _stages[name] = _stages.get(name, 0) + time.perf_counter() - start
+
+def record(key, **values):
+    """Add values (seconds, bytes_read, ...) to a chapter's record.
+
+    key is "{version}/{Book}-{chapter}".
+    """
+    if not _enabled:
+        return
+    entry = _chapters.setdefault(key, {})
+    for name, value in values.items():
+        entry[name] = entry.get(name, 0) + value
+
+def count(name, value):
+    if _enabled:
+        _counters[name] = _counters.get(name, 0) + value
+
+def chapter_key(version, book_name, chapter_num):
+    return "{}/{}-{}".format(version, book_name, chapter_num)
+
+def pop_entries():
+    """Return (and forget) what was recorded since the last call, or None."""
+    global _chapters
+    if not _enabled:
+        return None
+    entries = {"chapters": _chapters, "cache": {os.getpid(): bible_cache.cache_stats()}}
+    _chapters = {}
+    return entries
+
+def merge_entries(entries):
+    if not entries:
+        return
+    for key, values in entries["chapters"].items():
+        record(key, **values)
+    _cache.update(entries["cache"])
+
+def cache_totals():
+    """The reference cache stats of this process and every worker, added up."""
+    processes = dict(_cache)
+    processes[os.getpid()] = bible_cache.cache_stats()
+    totals = {}
+    for stats in processes.values():
+        for name, counts in stats.items():
+            total = totals.setdefault(name, {})
+            for field, value in counts.items():
+                total[field] = total.get(field, 0) + value
+    return totals
+
+def book_totals():
+    """Chapter records added up per book, slowest book first."""
+    books = {}
+    for key, values in _chapters.items():
+        book = key.rsplit("-", 1)[0]
+        total = books.setdefault(book, {"chapters": 0})
+        total["chapters"] += 1
+        for name, value in values.items():
+            total[name] = total.get(name, 0) + value
+    return dict(sorted(books.items(), key=lambda item: -item[1].get("seconds", 0)))
+
+def profile_summary(profiler, limit=30):
+    """The functions with the most cumulative time, as text."""
+    out = io.StringIO()
+    pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(limit)
+    return out.getvalue()
+
+def save_report(path, script, seconds, profiler=None):
+    totals = {}
+    for values in _chapters.values():
+        for name, value in values.items():
+            totals[name] = totals.get(name, 0) + value
+
+    report = {
+        "script": script,
+        "argv": sys.argv,
+        "finished": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "seconds": seconds,
+        "stages": _stages,
+        "totals": totals,
+        "counters": _counters,
+        "cache": cache_totals(),
+        "books": book_totals(),
+        "chapters": _chapters,
+        "profile": profile_summary(profiler).splitlines() if profiler else None
+    }
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w", encoding='utf-8') as f:
+        f.write(json.dumps(report, indent=4))
+
+def add_arguments(parser):
+    parser.add_argument("--report", help = "Save timings, byte counts and reference cache hits to this json file.", required=False)
+    parser.add_argument("--profile", help = "Run under cProfile and save the stats to this file (for pstats or snakeviz). Only the main process is profiled, use -j 1 to see the parsing.", required=False)
+
+def run(main, args, script):
+    """Call main(args), recording a report and / or profile if asked to."""
+    report_path = args.pop("report", None)
+    profile_path = args.pop("profile", None)
+    if not report_path and not profile_path:
+        return main(args)
+
+    enable()
+    profiler = cProfile.Profile() if profile_path else None
+    start = time.perf_counter()
+    try:
+        if profiler:
+            profiler.runcall(main, args)
+        else:
+            main(args)
+    finally:
+        seconds = time.perf_counter() - start
+        if profiler:
+            profiler.dump_stats(profile_path)
+        if report_path:
+            save_report(report_path, script, seconds, profiler)
+            print("Saved report to {}".format(report_path))
@@ -0,0 +1,70 @@
+import json
+import mmap
+import os
+import sys
+
+from array import array
+from pathlib import Path
+
+# int32 arrays saved one after another in a .bin file, with a .json file of
+# the same name saying where each one starts (plus whatever the caller wants
+# to keep with them). They are read back with mmap, so opening them is cheap
+# and only the pages that are used are read from disk.
+
+def save_arrays(path, arrays, **header):
+    """Save {name: array("i")} to path and the header to path.json."""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    layout = {}
+    position = 0
+    # Worker processes may save the same arrays at the same time, each
+    # writes its own file and moves it into place.
+    tmp = Path("{}.{}.tmp".format(path, os.getpid()))
+    with open(tmp, "wb") as f:
+        for name, values in arrays.items():
+            layout[name] = [position, len(values)]
+            values.tofile(f)
+            position += len(values) * values.itemsize
+    os.replace(tmp, path)
+
+    header["byteorder"] = sys.byteorder
+    header["itemsize"] = array("i").itemsize
+    header["arrays"] = layout
+    with open(tmp, "w", encoding='utf-8') as f:
+        f.write(json.dumps(header, indent=4))
+    os.replace(tmp, path.with_suffix(".json"))
+
+def read_header(path):
+    """The header saved with the arrays in path, None if there are none."""
+    path = Path(path).with_suffix(".json")
+    if not path.exists():
+        return None
+    with open(path, "r", encoding='utf-8') as f:
+        return json.loads(f.read())
+
+class MappedArrays:
+    """The arrays saved by save_arrays, as memoryviews of the mapped file."""
+    def __init__(self, path):
+        self.path = Path(path)
+        self.header = read_header(self.path)
+        if self.header is None:
+            raise FileNotFoundError("No arrays saved in {}.".format(self.path))
+        if self.header["byteorder"] != sys.byteorder or self.header["itemsize"] != array("i").itemsize:
+            raise ValueError("{} was saved on a different platform, build it again.".format(self.path))
+
+        self._file = open(self.path, "rb")
+        # mmap can't map an empty file (i.e. a version without any links).
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(self._file.fileno()).st_size else None
+        view = memoryview(self._mmap if self._mmap else b"")
+        self.arrays = {}
+        for name, (start, count) in self.header["arrays"].items():
+            self.arrays[name] = view[start:start + count * self.header["itemsize"]].cast("i")
+
+    def close(self):
+        # The views have to go before the map they point into.
+        for view in self.arrays.values():
+            view.release()
+        self.arrays = {}
+        if self._mmap:
+            self._mmap.close()
+        self._file.close()
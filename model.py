@@ -0,0 +1,108 @@
+import json
+
+# The verses parse.py saves and generate_tif.py reads. Both scripts (and the
+# verse store) pass Verse objects around instead of dicts. __slots__ keeps
+# each verse small and to_dict / from_dict are the only way in and out of
+# json, so the chapter files stay exactly as they have always been.
+
+try:
+    # orjson is optional (pip install orjson) and only used for reading.
+    # The chapter files are written with the json module because orjson
+    # can't produce the same bytes (4 space indents, escaped non-ascii).
+    import orjson
+    loads = orjson.loads
+except ImportError:
+    loads = json.loads
+
+class Note:
+    """A footnote or cross reference, i.e. ref "a" with text "Or, valor".
+
+    Saved in the chapter json as {ref: text}.
+    """
+    __slots__ = ("ref", "text")
+
+    def __init__(self, ref, text):
+        self.ref = ref
+        self.text = text
+
+    def __repr__(self):
+        return "<Note: {} {}>".format(self.ref, self.text)
+
+    def __eq__(self, other):
+        return isinstance(other, Note) and self.ref == other.ref and self.text == other.text
+
+    def to_dict(self):
+        return {self.ref: self.text}
+
+    @classmethod
+    def from_dict(cls, obj):
+        (ref, text), = obj.items()
+        return cls(ref, text)
+
+class Verse:
+    """Verse object for bible verses
+
+    verse_id is pythonbible's verse id (i.e. 1001001 for Genesis 1:1) so it
+    holds the book, chapter and verse.
+    """
+    __slots__ = ("verse_id", "text", "version", "clsstr", "footnotes", "crossrefs")
+
+    def __init__(self, verse_id, version, clsstr, text="", footnotes=None, crossrefs=None):
+        self.verse_id = verse_id
+        self.text = text
+        self.version = version
+        self.clsstr = clsstr
+
+        # need to intantiate empty list here to prevent all Verse instances
+        #  sharing a reference to a single list object.
+        self.footnotes = [] if footnotes is None else footnotes
+        self.crossrefs = [] if crossrefs is None else crossrefs
+
+    def __repr__(self):
+        return "<Verse: {} {}>".format(self.clsstr, self.version)
+
+    def to_string(self):
+        return "{} `{}` ({})".format(self.clsstr, self.text, self.version)
+
+    def to_dict(self):
+        # Same keys in the same order as the chapter json.
+        return {
+            "verse_id": self.verse_id,
+            "text": self.text,
+            "version": self.version,
+            "clsstr": self.clsstr,
+            "footnotes": [note.to_dict() for note in self.footnotes],
+            "crossrefs": [note.to_dict() for note in self.crossrefs]
+        }
+
+    @classmethod
+    def from_dict(cls, obj):
+        return cls(
+            obj["verse_id"],
+            obj["version"],
+            obj["clsstr"],
+            obj["text"],
+            [Note.from_dict(note) for note in obj["footnotes"]],
+            [Note.from_dict(note) for note in obj["crossrefs"]]
+        )
+
+    def add_crossref(self, crossref):
+        self.crossrefs.append(crossref)
+
+    def add_footnote(self, footnote):
+        self.footnotes.append(footnote)
+
+    def equals(self, other):
+        """Checks if provided Verse is equal to this one
+        """
+        if not isinstance(other, Verse):
+            return False
+        return self.version == other.version and self.verse_id == other.verse_id
+
+def encode_chapter(book):
+    """The chapter json saved by parse.py for a parse.Book."""
+    return json.dumps(book.to_dict(), indent=4)
+
+def decode_verses(text):
+    """The Verses in chapter json (str or bytes)."""
+    return [Verse.from_dict(verse) for verse in loads(text)["verses"]]
@@ -1,6 +1,10 @@
+import argparse
 import json
 import re
+import time
 
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 from pathlib import Path
 
 import pythonbible as bible
@@ -8,7 +12,24 @@ import pythonbible as bible
 from bs4 import BeautifulSoup, NavigableString, Tag, ResultSet
 from tqdm import tqdm
 
+import bible_cache
+import instrument
+import verse_table
+from model import Note, Verse, encode_chapter
+from backends import PARSERS, get_parser, make_soup
+from renderers import OUTPUT_FORMATS, get_renderer
+from build_state import BuildState, code_fingerprint, config_fingerprint, digest, file_digest
+from store import VerseStore, store_path
+from versions import load_configs
+
 class Book:
+    """The verses parsed from one chapter of a book.
+
+    Saved as {Book}-{chapter}.json by write_chapter. _b is the pythonbible
+    reference for the whole book, it is kept in the json for compatibility.
+    """
+    __slots__ = ("_b", "book", "version", "verses", "_verse_index", "short_title", "chapters")
+
     def __init__ (self, name, version):
         self._b = self._get_book(name) 
         if self._b[0]:
@@ -18,6 +39,8 @@ class Book:
 
         self.version = version
         self.verses = []
+        # verse_id -> Verse for the verses in self.verses, in the same order.
+        self._verse_index = {}
         self.short_title = self._get_short_title(name)
         self.chapters = self._get_chapters()
     
@@ -28,7 +51,7 @@ class Book:
             return 0
 
     def _get_book(self, name):
-        ref = bible.get_references(name)
+        ref = bible_cache.get_references(name)
         if ref:
             return (True, ref[0])
         else:
@@ -36,7 +59,7 @@ class Book:
 
     def _get_short_title(self, name):
         if self.book:
-            t = bible.get_book_titles(self.book)
+            t = bible_cache.get_book_titles(self.book)
             if t:
                 return t.short_title 
             else:
@@ -44,146 +67,166 @@ class Book:
         else:
             return name
         
+    def add_verse(self, verse):
+        self.verses.append(verse)
+        self._verse_index[verse.verse_id] = verse
+
+    def get_verse(self, verse_id):
+        return self._verse_index.get(verse_id)
+
+    def to_dict(self):
+        # The verse index can be rebuilt from the verses, don't save it.
+        return {
+            "_b": [self._b[0], vars(self._b[1]) if self._b[1] else None],
+            "book": self.book,
+            "version": self.version,
+            "verses": [verse.to_dict() for verse in self.verses],
+            "short_title": self.short_title,
+            "chapters": self.chapters
+        }
+
     def toJSON(self):
-        return json.dumps(self, default=lambda o: o.__dict__, 
-            sort_keys=True, indent=4)
+        return json.dumps(self.to_dict(), sort_keys=True, indent=4)
     
 class BookEncoder(json.JSONEncoder):
     def default(self, o):
-        return o.__dict__
-
-class Verse():
-    """Verse object for bible verses
+        return o.to_dict()
+
+# Patterns used on every class string and footnote id, compiled once.
+VERSE_CLASS = re.compile(r"(.+)-(\d+)-(\d+)")
+INDENT_CLASS = re.compile(r"indent-(\d+)")
+INDENT_BREAKS_CLASS = re.compile(r"indent-(\d+)-breaks")
+FOOTNOTE_ID = re.compile(r"[A-Za-z]+-[A-Za-z]+-\d+([a-z]+)")
+CROSSREF_ID = re.compile(r"[A-Za-z]+-[A-Za-z]+-\d+([A-Z]+)")
+DOUBLE_SPACES = re.compile(r" {2,}")
+
+class VerseText:
+    """The text of one verse, collected as a list of fragments.
+
+    Adding to a string copies everything written so far, which made long
+    verses (Psalm 119) quadratic. The fragments are joined once by getvalue.
+
+    Footnotes used to strip double spaces from the whole verse every time
+    one was added, so a run of spaces is halved once for every note after
+    it. collapse_spaces only remembers where the note was and getvalue
+    halves each run the same number of times.
     """
-    def __init__(self, verse_id, version, clsstr, text="", footnotes=None, crossrefs=None):
-        # super().__init__(book, chapter, verse)
-        # self.reference = reference
-        self.verse_id = verse_id
-        self.text = text
-        self.version = version
-        self.clsstr = clsstr
-    
-        # need to intantiate empty list here to prevent all Verse instances
-        #  sharing a reference to a single list object.
-        if footnotes is None:
-            self.footnotes = []
-        else:
-            self.footnotes = footnotes
+    __slots__ = ("parts", "length", "collapses")
+
+    def __init__(self, text=""):
+        self.reset(text)
+
+    def reset(self, text):
+        self.parts = [text]
+        self.length = len(text)
+        # The length of the text when each note was added.
+        self.collapses = []
+
+    def append(self, text):
+        self.parts.append(text)
+        self.length += len(text)
+
+    def collapse_spaces(self):
+        """Same as text.replace("  ", " ") on the text so far."""
+        self.collapses.append(self.length)
+
+    def _collapse_run(self, m):
+        start, end = m.span()
+        # Spaces of this run written so far, and how many are left.
+        pos = start
+        run = 0
+        for collapse in self.collapses:
+            if collapse <= start:
+                continue
+            taken = min(collapse, end) - pos
+            run += taken
+            pos += taken
+            # replace("  ", " ") turns n spaces into ceil(n / 2).
+            run = (run + 1) // 2
+        return " " * (run + end - pos)
+
+    def getvalue(self):
+        text = "".join(self.parts)
+        if not self.collapses:
+            return text
+        return DOUBLE_SPACES.sub(self._collapse_run, text)
+
+def tag_classes(tag):
+    # bs4 keeps class as a list of class names.
+    return tag.get("class") or ()
 
-        if crossrefs is None:
-            self.crossrefs = []
-        else:
-            self.crossrefs = crossrefs
+def find_class(tag, class_name):
+    return class_name in tag_classes(tag)
+
+def tag_kind(tag, classes):
+    """Which formatter in TAG_FORMATTERS handles this tag, None if none does."""
+    # If this is an opening section add a paragraph mark.
+    if "chapternum" in classes or "versenum" in classes or tag.name == "versenum":
+        # Some chapters start in the middle of a paragraph (Numbers 23).
+        return "opening" if "opening" in classes else None
+    # Superscript elements. These are used inline for footnotes and cross references.
+    if tag.name == "sup":
+        return "note" if "footnote" in classes or "crossreference" in classes else None
+    # Poetry is handled in the calling code.
+    if tag.name == "div":
+        return None
+    # Handle small-capped LORD
+    if "small-caps" in classes:
+        return "small-caps"
+    return None
 
-    def __repr__(self):
-        # TODO
-        return "<Verse: {}>".format(super().to_string())
-        # return ""
+# The formatters add to verse_text, a VerseText, using the renderer for the
+# output format.
 
-    def to_string(self):
-        return "{} `{}` ({})".format(super().to_string(),self.text,self.version)
+def format_opening(renderer, verse_text, tag):
+    # Anything before the paragraph mark is dropped.
+    verse_text.reset("¶ ")
 
-    def to_dict(self):
-        return dict(
-            book = self.book,
-            chapter = self.chapter,
-            verse = self.verse,
-            version = self.version,
-            text = self.text,
-            footnotes = self.footnotes,
-            crossrefs = self.crossrefs
-        )
-
-    @classmethod
-    def from_dict(cls,obj):
-        return cls(**obj)
-
-    def add_crossref(self, crossref):
-        self.crossrefs.append(crossref)
-
-    def add_footnote(self, footnote):
-        self.footnotes.append(footnote)
-
-    def equals(self, other):
-        """Checks if provided Verse is equal to this one
-        """
-        if not isinstance(other,Verse):
-            return False
-        return self.version == other.version\
-            and self.chapter == other.chapter\
-            and self.book == other.book\
-            and self.verse == other.verse
+def format_note(renderer, verse_text, tag):
+    verse_text.append(renderer.note(tag.text))
 
-def find_class(tag, class_name):
-    if tag.has_attr("class"):
-        for attr in tag.attrs:
-            if attr == "class":
-                for c in tag["class"]:
-                    if c == class_name:
-                        return True
-    return False
-
-def format_tag(config, verse_text, tag):
+    # Verse footnote placement isn't consistent between versions. Strip double spaces in output.
+    verse_text.collapse_spaces()
+
+def format_small_caps(renderer, verse_text, tag):
+    verse_text.append(renderer.small_caps())
+
+TAG_FORMATTERS = {
+    "opening": format_opening,
+    "note": format_note,
+    "small-caps": format_small_caps
+}
+
+def format_tag(renderer, verse_text, tag):
+    """Add the formatted text of tag to verse_text, a VerseText."""
     if isinstance(tag, ResultSet):
         print("1. Shouldn't be here.")
     if isinstance(tag, Tag):
-        if find_class(tag, "text"):
+        # Look the classes up once, everything below checks them.
+        classes = tag_classes(tag)
+        if "text" in classes:
             # This is the first entry in poetry:
             for child in tag:
-                verse_text = format_tag(config, verse_text, child)
-        
-        # If this is an opening section add a paragraph mark.
-        if find_class(tag, "chapternum") or find_class(tag, "versenum") or tag.name == "versenum":
-            if find_class(tag, "opening"):
-                verse_text = "¶ "
-        # Superscript elements. These are used inline for footnotes and cross references. 
-        elif tag.name == "sup":
-            if find_class(tag, "footnote") or find_class(tag, "crossreference"):
-                if config["output_format"] == "markdown":
-                    verse_text += tag.text.replace("[", " __[").replace("]", "]__").replace("(", " __(").replace(")", ")__")
-                elif config["output_format"] == "html":
-                    verse_text += tag.text.replace("[", " <i>[").replace("]", "]</i>").replace("(", " <i>(").replace(")", ")</i>")
-                
-                # Verse footnote placement isn't consistent between versions. Strip double spaces in output.
-                verse_text = verse_text.replace("  ", " ")
-        elif tag.name == "div":
-            if find_class(tag, "poetry"):
-                # Poetry is handled in the calling code, but keep it here for completeness.
-                pass
-        # Handle small-capped LORD
-        elif find_class(tag, "small-caps"):
-            if config["output_format"] == "markdown":
-                verse_text += "**LORD**"
-            elif config["output_format"] == "html":
-                verse_text += "<b>LORD</b>"
-        elif tag.name == "versenum": # Numbers 23
-            # Some chapters tstart in the middle of a paragraph.
-            pass
+                format_tag(renderer, verse_text, child)
+
+        formatter = TAG_FORMATTERS.get(tag_kind(tag, classes))
+        if formatter:
+            formatter(renderer, verse_text, tag)
     elif isinstance(tag, NavigableString):
         # If the tag is just text append it.
-        verse_text += str(tag.string)
+        verse_text.append(str(tag.string))
     else:
         # Something went wrong and the tag wasn't handled by one of the cases above.
         print("3 Shouldn't be here.")
-        return verse_text
-    
-    # Return a true or false if the verse text should get passed up to book object.
-    return verse_text
 
-def format_footnote(text, tag):
+def format_footnote(renderer, text, tag):
     if isinstance(tag, Tag):
         if tag.name == "i":
-            if config["output_format"] == "markdown":
-                text += "__{}__".format(tag.text)
-            elif config["output_format"] == "html":
-                text += "<i>{}</i>".format(tag.text)
+            text += renderer.italic(tag.text)
         elif find_class(tag, "small-caps"):
-            if config["output_format"] == "markdown":
-                text += "**LORD**"
-            elif config["output_format"] == "html":
-                text += "<b>LORD</b>"
+            text += renderer.small_caps()
         elif tag.name == "a":
-            text += "[[{}]]".format(tag.text)
+            text += renderer.link(tag.text)
     elif isinstance(tag, NavigableString):
         text += tag.text
     else:
@@ -192,7 +235,7 @@ def format_footnote(text, tag):
     return text
 
 def normalize_verse_class(text):
-    m = re.match("(.+)-(\d+)-(\d+)", text)
+    m = VERSE_CLASS.match(text)
     if m:
         if len(m.groups()) == 3:
             return {
@@ -206,307 +249,533 @@ def normalize_verse_class(text):
     else:
         return None
 
+@lru_cache(maxsize=None)
+def _find_class_verse(classes):
+    # The verse depends only on the class strings, which repeat for every
+    # text span of a verse.
+    for clsstr in classes:
+        n = normalize_verse_class(clsstr)
+        book = bible_cache.get_book(n["book"]) if n else None
+        verse_id = verse_table.get_table().verse_id(book.value, int(n["chapter"]), int(n["verse"])) if book else None
+        if verse_id:
+            return {
+                "found": True,
+                "clsstr": n["ref"],
+                "verse_id": verse_id
+            }
+    return {"found": None, "clsstr": None, "bcv": None}
+
 def find_class_verse(tag):
     # If this somehow got called with a NavigableString or List bail out.
-    if isinstance(tag, Tag):
-
-        # check for a class attribute. The verse will get parsed from 
-        # the tag's class.
-        if tag.has_attr("class"):
-            for attr in tag.attrs:
-                if attr == "class":
-                    for clsstr in tag.attrs['class']:
-                        n = normalize_verse_class(clsstr)
-                        found = None
-                        if n:
-                            found = bible.get_references("{} {}:{}".format(n["book"], n["chapter"], n["verse"]))
-                        if found:
-                            return {
-                                "found": True,
-                                "clsstr": n["ref"],
-                                "verse_id": bible.convert_reference_to_verse_ids(found[0])[0]
-                            }
-                            # return [True, (n["ref"], found)]
-    else:
+    if not isinstance(tag, Tag):
         raise TypeError("find_class_verse expects a Tag.")
-    
-    return {"found": None, "clsstr": None, "bcv": None}
 
-if __name__ == '__main__':
+    # The verse will get parsed from the tag's class.
+    return dict(_find_class_verse(tuple(tag_classes(tag))))
 
-    problem_verses = []
+def output_formats(config):
+    """The formats parse.py renders, config["output_format"] unless -f was used."""
+    return config.get("output_formats") or [config["output_format"]]
 
-    # Set these to None to run all books, or chapter, or verses.
-    debug = None # "Gen-2-1"
+def parse_chapter(config, book_name, chapter_num, debug=None, html=None):
+    """Parse one chapter's html saved by download.py, or the html passed in.
 
-    with open(Path("config.json"), "r") as f:
-        config = json.loads(f.read())
+    Returns a Book holding only this chapter's verses (the object that is
+    written to {Book}-{chapter}.json) and a list of problems found while
+    parsing.
+    """
+    books, problem_verses = parse_chapter_formats(config, book_name, chapter_num, [config["output_format"]], debug, html)
+    return books[config["output_format"]], problem_verses
+
+def parse_chapter_formats(config, book_name, chapter_num, formats, debug=None, html=None):
+    """Like parse_chapter, but renders the verses in each of formats.
 
-    with open(Path("books", "input", config["version"], "chapters_{}.json".format(config["version"])), 'r') as f:
-        books = json.loads(f.read())
+    The page is only parsed once. Returns {format: Book} and the problems
+    found while parsing.
+    """
+    renderers = [get_renderer(output_format) for output_format in formats]
+
+    # Open the html saved by download.py, unless the caller already has it
+    # (i.e. tana_bible.py all, which parses pages straight from the network).
+    if html is None:
+        with open(Path("books", "input", config["version"], "html", "{}-{}.html".format(
+                book_name,
+                str(chapter_num)))
+            , "r", encoding='utf-8') as f:
+            html = f.read()
+
+    # Initialize the bs4 parser. html.parser works fine with the
+    # html served by biblegateway, lxml is faster when it is installed.
+    start = time.perf_counter()
+    soup = make_soup(html, config.get("parser"))
+    parsed = time.perf_counter()
+
+    # Create an empty dict to hold chapter verse info (verse id -> class string).
+    # As far as the author can tell all the text we want from biblegateway
+    # is always conatined in a tag (or child) that has a class "text".
+    verse_ids = dict()
+    
+    # Text spans grouped by their whole class string (i.e. "text Gen-1-1"),
+    # in document order.
+    passages = dict()
+
+    # Build a unique list of verses on this chapter's html page. The same
+    # walk of the document buckets the text spans for each verse so the
+    # verse loop below doesn't have to search the whole page again.
+    for node in soup.find_all(class_="text"):
+        if node.name == "span":
+            passages.setdefault(" ".join(node["class"]), []).append(node)
+
+        class_verse = find_class_verse(node)
+        if class_verse["found"]:
+            verse_ids.setdefault(class_verse["verse_id"], class_verse["clsstr"])
+
+    books = {}
+    problem_verses = None
+    for renderer in renderers:
+        this_book = Book(name=book_name, version=config["version"])
+
+        # this_book.verses will hold all the individual verses that make up a book.
+        # Verses is flat, the verse object itself holds the chapter info.
+
+        this_book.chapters = chapter_num
+        for verse_id, clsstr in verse_ids.items():
+            this_book.add_verse(Verse(verse_id, this_book.version, clsstr))
+
+        problems = format_chapter(renderer, this_book, soup, passages, chapter_num, debug)
+        # The problems are the same in every format, report them once.
+        if problem_verses is None:
+            problem_verses = problems
+        books[renderer.name] = this_book
+
+    # Time spent in BeautifulSoup versus walking the tree and formatting text.
+    if instrument.enabled():
+        instrument.record(instrument.chapter_key(config["version"], book_name, chapter_num),
+            parse_seconds=parsed - start,
+            format_seconds=time.perf_counter() - parsed,
+            bytes_read=len(html.encode("utf-8")))
+
+    return books, problem_verses
+
+def format_chapter(renderer, this_book, soup, passages, chapter_num, debug=None):
+    """Fill in the text, footnotes and cross references of this_book's verses.
+
+    passages are the text spans of each verse found by parse_chapter_formats.
+    Returns a list of problems found.
+    """
+    problem_verses = []
 
-    for book in books["books"]:
+    INDENT = "    "
 
-        found_types = []
+    # Start looping through the verses.
+    for v in this_book.verses:
+        
+        # Uncomment out this block to process a specific verse
+        if debug != None:
+            if debug != v.clsstr:
+                continue
+        
+        # What will be the output of this verse
+        text = VerseText()
         
-        INDENT = "    "
-        refs = []
+        # Find all the verses with this verse's class string (i.e. Gen-1-1)
+        text_passages = passages.get("text {}".format(v.clsstr), [])
+        
+        # We need to keep track of how many times we've looped through this
+        # verse's elements.
+        i = 0
+        if text_passages:
+            for passage in text_passages:
+
+                # h3 are section headers. They can occur before a chapter-verse
+                # or within a verse (but include one after).
+                if passage.parent.name == "h3":
+
+                    # If the element has a previous sibling then it needs a a newline
+                    # before the heading.
+                    if passage.parent.previous_sibling:
+                        text.append(renderer.heading(passage.text, False))
+                    # Otherwise it doesn't (but do include one after).
+                    else:
+                        text.append(renderer.heading(passage.text, True))
+                
+                # If the element's parent is a versenum then this 
+                # element is a verse.
+                elif passage.parent.name == "versenum":
+                    if passage.parent.previous_sibling:
+                        text.append(renderer.heading(passage.text, False))
+                    else:
+                        text.append(renderer.heading(passage.text, True))
+                else:
+
+                    # If the element doesn't have previous siblings or isn't
+                    # an h3, then it needs a paragraph mark.
+                    if not passage.previous_sibling:
+                        text.append("¶ ")
+
+                    # Poetry check.
+                    # Does this element have a poetry encestor?
+                    parents = list(passage.parents)
+                    if any(parent.name == "div" and "poetry" in tag_classes(parent) for parent in parents):
+                        # Is this element indented?
+                        # The following will calculate how many 
+                        # indent levels are needed.
+                        for parent in parents:
+                            if parent.name != "span":
+                                continue
+                            for clsstr in parent.attrs['class']:
+                                m = INDENT_CLASS.search(clsstr)
+                                if m:
+                                    if m.groups(0):
+                                        indent_string = INDENT * int(m.groups(0)[0])
+                                        continue
+                        # newlines after the first poetry line.
+                        if i == 0:
+                            text.append(INDENT)
+                        else:
+                            # lines at the same indent level may have leading spaces (2nd line in Gen 1:27)
+                            if passage.previous_sibling:
+                                if passage.previous_sibling.has_attr("class"):
+                                    for clsstr in passage.previous_sibling.attrs["class"]:
+                                        m = INDENT_BREAKS_CLASS.search(clsstr)
+                                        if m:
+                                            previous_text = passage.previous_sibling.text
+                                            leading_indent = previous_text.replace(u'\xa0', ' ')
+                                            text.append(leading_indent)
+                            else:
+                                pass # text.append("\n" + INDENT)
+
+                        # So far we've been dealing with parent tags, format_tag
+                        # will format the element with the text.
+                        format_tag(renderer, text, passage)
+
+                        # Each line of poetry should have a newline at the end
+                        text.append("\n" + INDENT)
+                        i += 1
+                    else:
+                        # So far we've been dealing with parent tags, format_tag
+                        # will format the element with the text.
+                        format_tag(renderer, text, passage)
+
+            # Set the verse's text to all the text accumulated.
+            v.text += text.getvalue()
+
+    # Find footnotes on the page.
+    footnotes_div = soup.find("div", {"class": "footnotes"})
+    if footnotes_div:
+
+        # Each footnote is stored in a orderered list item.
+        footnotes = footnotes_div.find_all("li")
+        for footnote in footnotes:
+            store = {}
+            store["text"] = ""
+            verse_id = None
+            c = None
+            v = None
+
+            # Each footnote will be referenced with something like fen-NRSVUE-30261a.
+            # The last letter(s) after the digits represent the footnote "letter".
+            ref = FOOTNOTE_ID.search(footnote.attrs["id"]).groups()[0]
+
+            # Find the footnote href element.
+            # In the NRSVUE this is represented as a two sets of digits separated by a dot. i.e. 10:15
+            # In the ASV this is a whole verse refeernce. i.e. Genesis 1:1
+            link = footnote.find("a")
+            if link:
+                store["verse_ref"] = link.text
+            
+            # Find the text of the footnote. Format as necessary.
+            objs = footnote.find("span", {"class": "footnote-text"})
+            if objs:
+                for obj in objs:
+                    store["text"] = format_footnote(renderer, store["text"], obj)
+            try:
+                # In the NSRVUE the footnote may be formatted like
+                # 10.15
+                # 2.31-32 (1 Samuel 2:31, 1 Kings 4:20-21) bible.convert_references_to_verse_ids(bible.get_references("1 Samuel 2:31-32"))
+                # 34.17-35.2 (Isaiah 35:17) bible.convert_references_to_verse_ids(bible.get_references("Isaiah 34:17-35:2"))
+                # pythonbible makes this easy.
+                # This will only work where biblegateway is formatting the footnote like "1.2".
+                if this_book.version == "NRSVUE":
+                    references = bible_cache.get_references("{} {}".format(this_book.short_title, store["verse_ref".replace(".", ":")]))
+                    verse_ids = bible_cache.convert_references_to_verse_ids(references)
+                elif this_book.version == "ASV":
+                    references = bible_cache.get_references("{}".format(store["verse_ref"]))
+                    verse_ids = bible_cache.convert_references_to_verse_ids(references)
+                
+                for verse_id in verse_ids:
+                    found_verse_object = this_book.get_verse(verse_id)
+                    if found_verse_object:
+                        found_verse_object.add_footnote(Note(ref, store["text"]))
+            except ValueError as e:
+                problem_verses.append("No valid verse format found in {} {}.".format(this_book.book, store["verse_ref"]))
 
-        this_book = Book(name=book["name"], version=config["version"])
-        print(this_book.short_title)
+            
 
-        for chapter_num in tqdm(range(1, this_book.chapters), initial=1, unit="verse", total=this_book.chapters):
+    # Cross references
+    crossrefs_div = soup.find("div", {"class": "crossrefs"})
+    if crossrefs_div:
+        # Each set of cross references is stored in a orderered list item.
+        crossrefs = crossrefs_div.find_all("li")
+        for crossref in crossrefs:
+            store = {}
+            store["text"] = ""
+
+            # List of found references in the html.
+            store["clist"] = []
             
-            # Verses will hold all the individual verses that make up a book.
-            # Verses is flat, the verse object itself holds the chapter info.
-            this_book.verses = []
-
-            this_book.chapters = chapter_num
-
-            # Open the html saves from download.py
-            with open(Path("books", "input", config["version"], "html", "{}-{}.html".format(
-                    book["name"], 
-                    str(chapter_num)))
-                , "r", encoding='utf-8') as f:
-
-                # Initialize the bs4 parser. html.parser works fine with the
-                # html served by biblegateway.
-                soup = BeautifulSoup(f, "html.parser")
-
-                # Create an empty dict to hold chapter verse info.
-                # As far as the author can tell all the text we want from biblegateway
-                # is always conatined in a tag (or child) that has a class "text".
-                verse_ids = dict()
+            # Each footnote will be referenced with something like cen-NRSVUE-2B.
+            # The last uppercase letter(s) after the digits represent the footnote "letter".
+            ref = CROSSREF_ID.search(crossref.attrs["id"]).groups()[0]
+            
+            # Find the footnote href element.
+            # In the NRSVUE this is represented as a two sets of digits separated by a dot. i.e. 10:15
+            try:
+                link = crossref.find("a")
+                if link:
+                    store["verse_ref"] = link.text
+
+                    # Full text of a reference is found in a data-bibleref attribute
+                    clist = [r.strip() for r in crossref.find(class_="crossref-link").attrs["data-bibleref"].split(",")]
+
+                    source_verse = bible_cache.get_references("{} {}".format(this_book.short_title, store["verse_ref".replace(".", ":")]))
+                    source_verse_id = bible_cache.convert_reference_to_verse_ids(source_verse[0])
+                    for c in clist:
+                        found_verse_object = this_book.get_verse(source_verse_id[0])
+                        found_verse_object.add_crossref(Note(ref, c))
+                        # TODO Think about how to store references like Job 38.26–28 or Gen 3.7, 10, 11.
+                        # verse_ids = bible.convert_references_to_verse_ids(bible.get_references(c))
+                        # if verse_ids:
+                        #     for verse_id in verse_ids:
+                        #         found_verse_object = this_book.get_verse(verse_id)
+                        #         if found_verse_object:
+                        #             found_verse_object.add_crossref({ref: verse_id})
+            except ValueError as e:
+                problem_verses.append("No valid verse format found in {} {}.".format(this_book.book, store["verse_ref"]))
                 
-                # Build a unique list of verses on this chapter's html page.
-                for node in soup.find_all(class_="text"):
-                    class_verse = find_class_verse(node)
-                    if class_verse["found"]:
-                        if len(this_book.verses) > 0:
-                            exists = next((item for item in this_book.verses if item.verse_id == class_verse["verse_id"]), None)
-                        else:
-                            exists = False
-                        if not exists:
-                            skeleton_verse = Verse(class_verse["verse_id"], this_book.version, class_verse["clsstr"])
-                            this_book.verses.append(skeleton_verse)
-
-                # Start looping through the verses.
-                for v in this_book.verses:
-                    
-                    # Uncomment out this block to process a specific verse
-                    if debug != None:
-                        if debug != v.clsstr:
-                            continue
-                    
-                    # What will be the output of this verse
-                    text = ""
-                    
-                    # Find all the verses with this verse's class string (i.e. Gen-1-1)
-                    text_passages = soup.find_all("span", {"class": "text {}".format(v.clsstr)})
-                    
-                    # We need to keep track of how many times we've looped through this
-                    # verse's elements.
-                    i = 0
-                    if text_passages:
-                        for passage in text_passages:
-
-                            # h3 are section headers. They can occur before a chapter-verse
-                            # or within a verse (but include one after).
-                            if passage.parent.name == "h3":
-
-                                # If the element has a previous sibling then it needs a a newline
-                                # before the heading.
-                                if passage.parent.previous_sibling:
-                                    if config["output_format"] == "markdown":
-                                        text += "\n**{}**\n".format(passage.text)
-                                    elif config["output_format"] == "html":
-                                        text += "\n<b>{}</b>\n".format(passage.text)
-                                # Otherwise it doesn't (but do include one after).
-                                else:
-                                    if config["output_format"] == "markdown":
-                                        text += "**{}**\n".format(passage.text)
-                                    if config["output_format"] == "html":
-                                        text += "<b>{}</b>\n".format(passage.text)
-                            
-                            # If the element's parent is a versenum then this 
-                            # element is a verse.
-                            elif passage.parent.name == "versenum":
-                                if passage.parent.previous_sibling:
-                                    if config["output_format"] == "markdown":
-                                        text += "\n**{}**\n".format(passage.text)
-                                    elif config["output_format"] == "html":
-                                        text += "\n<b>{}</b>\n".format(passage.text)
-                                else:
-                                    if config["output_format"] == "markdown":
-                                        text += "**{}**\n".format(passage.text)
-                                    if config["output_format"] == "html":
-                                        text += "<b>{}</b>\n".format(passage.text)
-                            else:
+    # Check for empty verses, this indicates something went wrong parsing the verse.
+    # If debug is not None this will be all wonky, do don't show.
+    if debug == None:
+        for v in this_book.verses:
+            if v.text == "":
+                problem_verses.append("Something wrong with {} {} {}.".format(this_book.book.title, chapter_num, v.verse_id % 1000))
+            
+            # A heading at the start of the verse doesn't need the newline before it.
+            if v.text.startswith("\n" + renderer.bold_start):
+                v.text = v.text[1:]
+
+    return problem_verses
+
+def write_chapter(config, book_name, chapter_num, this_book, output_format=None):
+    """Save this_book to books/output/{version}/{output_format}/{Book}-{chapter}.json.
+
+    output_format defaults to config["output_format"].
+    """
+    folder = Path("books", "output", config["version"], output_format or config["output_format"])
+    folder.mkdir(parents=True, exist_ok=True)
+    with open(Path(folder, "{}-{}.json".format(book_name, str(chapter_num))), "w", encoding='utf-8') as f:
+        output = encode_chapter(this_book)
+        f.write(output)
+    if instrument.enabled():
+        instrument.record(instrument.chapter_key(config["version"], book_name, chapter_num), bytes_written=len(output.encode("utf-8")))
+
+def get_chapter_count(book_name):
+    # The number of chapters comes from pythonbible rather than chapters_{version}.json.
+    return Book(name=book_name, version=None).chapters
+
+def parse_and_write_chapter(task):
+    """Parse and save one (config, book name, chapter, debug) task.
+
+    This is the unit of work handed to the process pool, so it only takes
+    and returns picklable objects. Returns the chapter's problems, the
+    reference strings parsed for the first time, when config["store"] is
+    set, the chapter in each output format for the parent process to save
+    in the verse store (otherwise the chapter's json files are written here)
+    and the instrument records, if any.
+    """
+    config, book_name, chapter_num, debug = task
+    start = time.perf_counter()
+    books, problems = parse_chapter_formats(config, book_name, chapter_num, output_formats(config), debug)
+    chapters = []
+    for output_format, this_book in books.items():
+        if config.get("store"):
+            # SQLite wants a single writer so the parent process saves it.
+            chapters.append((config["version"], output_format, this_book.book.value, chapter_num,
+                this_book.verses))
+        else:
+            write_chapter(config, book_name, chapter_num, this_book, output_format)
+    instrument.record(instrument.chapter_key(config["version"], book_name, chapter_num), seconds=time.perf_counter() - start)
+    # Send newly parsed reference strings back so the parent process can
+    # save them in the disk cache.
+    return problems, bible_cache.pop_new_entries(), chapters, instrument.pop_entries()
+
+def store_chapter(stores, chapter):
+    """Save a chapter returned by parse_and_write_chapter in its version's store."""
+    version, output_format, book, chapter_num, verses = chapter
+    key = (version, output_format)
+    if key not in stores:
+        stores[key] = VerseStore(store_path(version, output_format))
+    stores[key].write_chapter(book, chapter_num, verses)
+
+def init_worker(cached_versions, instrumented=False):
+    for version in cached_versions:
+        bible_cache.load_disk_cache(version)
+    if instrumented:
+        instrument.enable()
+
+def parse_chapters(tasks, jobs=1, cached_versions=(), on_done=None):
+    """Parse a list of chapter tasks, serially or across a process pool.
+
+    Problems are returned in the order of tasks no matter which process
+    handled each chapter, so the report is the same as a serial run.
+    cached_versions are the versions whose reference disk cache the worker
+    processes should load. on_done(task, problems) is called as each chapter
+    is saved.
+    """
+    problem_verses = []
+    stores = {}
+    executor = None
+    try:
+        if jobs <= 1:
+            results = map(parse_and_write_chapter, tasks)
+        else:
+            executor = ProcessPoolExecutor(max_workers=jobs, initializer=init_worker, initargs=(cached_versions, instrument.enabled()))
+            # executor.map yields results in submission order.
+            results = executor.map(parse_and_write_chapter, tasks, chunksize=8)
+
+        for task, (problems, entries, chapters, records) in zip(tasks, tqdm(results, total=len(tasks), unit="chapter")):
+            problem_verses.extend(problems)
+            bible_cache.merge_entries(entries)
+            instrument.merge_entries(records)
+            for chapter in chapters:
+                store_chapter(stores, chapter)
+            if on_done:
+                on_done(task, problems)
+    finally:
+        if executor:
+            executor.shutdown()
+        for store in stores.values():
+            store.close()
+    return problem_verses
+
+# Source files whose changes mean every chapter has to be parsed again.
+PARSE_SOURCES = ["parse.py", "backends.py", "bible_cache.py", "verse_table.py", "mapped_arrays.py", "store.py", "model.py", "renderers.py"]
+
+def parse_state_path(config):
+    target = "store" if config.get("store") else "json"
+    return Path("books", "output", config["version"], "cache", "parse_{}_{}.json".format("-".join(output_formats(config)), target))
+
+def chapter_fingerprint(config, book_name, chapter_num, code):
+    html = Path("books", "input", config["version"], "html", "{}-{}.html".format(book_name, chapter_num))
+    return digest(
+        file_digest(html),
+        config_fingerprint(config, ["version", "output_format", "output_formats", "parser", "store"]),
+        code
+    )
+
+def parse_incremental(tasks, jobs=1, cached_versions=()):
+    """Only parse the chapters whose html, config or parsing code changed.
+
+    Every chapter's fingerprint (and the problems found in it) is kept in
+    books/output/{version}/cache/parse_{output_formats}_{json|store}.json.
+    Unchanged chapters keep their existing output and their saved problems
+    are reported again, in task order.
+    """
+    code = code_fingerprint(PARSE_SOURCES)
+    states = {}
+    fingerprints = {}
+    stale = []
+    for task in tasks:
+        config, book_name, chapter_num, debug = task
+        path = parse_state_path(config)
+        if path not in states:
+            states[path] = BuildState(path)
+        key = "{}-{}".format(book_name, chapter_num)
+        fingerprint = chapter_fingerprint(config, book_name, chapter_num, code)
+        fingerprints[(path, key)] = fingerprint
+
+        outputs = [Path("books", "output", config["version"], output_format, "{}.json".format(key)) for output_format in output_formats(config)]
+        if debug or not states[path].is_current(key, fingerprint) or not (config.get("store") or all(output.exists() for output in outputs)):
+            stale.append(task)
+
+    print("{} of {} chapters need to be parsed.".format(len(stale), len(tasks)))
+
+    def on_done(task, problems):
+        config, book_name, chapter_num, debug = task
+        path = parse_state_path(config)
+        key = "{}-{}".format(book_name, chapter_num)
+        # A debug run only parses some verses, don't remember it.
+        if not debug:
+            states[path].record(key, fingerprints[(path, key)], problems=problems)
+
+    try:
+        parse_chapters(stale, jobs, cached_versions, on_done)
+    finally:
+        # Save what finished so an interrupted run isn't repeated.
+        for state in states.values():
+            state.save()
+
+    problem_verses = []
+    for config, book_name, chapter_num, debug in tasks:
+        entry = states[parse_state_path(config)].get("{}-{}".format(book_name, chapter_num))
+        if entry:
+            problem_verses.extend(entry["problems"])
+    return problem_verses
+
+def add_arguments(parser):
+    parser.add_argument("-v", "--versions", nargs = "+", help = "Versions to parse. Each must be the default version or listed under versions in config.json. If ommited the default version in config.json is parsed.", required=False)
+    parser.add_argument("-j", "--jobs", type=int, default=1, help = "Number of processes used to parse chapters. Defaults to 1.", required=False)
+    parser.add_argument("-s", "--store", action="store_true", help = "Save the verses to books/output/{version}/verses_{output_format}.sqlite instead of one json file per chapter.", required=False)
+    parser.add_argument("-i", "--incremental", action="store_true", help = "Only parse chapters whose html, config or parsing code changed since the last incremental run.", required=False)
+    parser.add_argument("--no-cache", action="store_true", help = "Don't load or save parsed references in books/output/{version}/cache.", required=False)
+    parser.add_argument("-p", "--parser", choices=PARSERS, help = "html parser used by BeautifulSoup. Falls back to html.parser if the parser isn't installed. Defaults to html.parser.", required=False)
+    parser.add_argument("-f", "--formats", nargs = "+", choices=OUTPUT_FORMATS, help = "Output formats to render from one parse of each page, each saved to books/output/{version}/{format}. Defaults to output_format in config.json.", required=False)
+    instrument.add_arguments(parser)
+
+def main(args):
+    # Set these to None to run all books, or chapter, or verses.
+    debug = None # "Gen-2-1"
+
+    # Chapters of every requested version go into one list of tasks so they
+    # share one pool of worker processes.
+    tasks = []
+    cached_versions = []
+    html_parser = get_parser(args["parser"])
+    for config in load_configs(args["versions"]):
+        config["parser"] = html_parser
+        config["store"] = args["store"]
+        if args["formats"]:
+            config["output_formats"] = args["formats"]
+        # Fail now on an unknown output_format, not in every worker.
+        for output_format in output_formats(config):
+            get_renderer(output_format)
+        if not args["no_cache"]:
+            bible_cache.load_disk_cache(config["version"])
+            cached_versions.append(config["version"])
+
+        with open(Path("books", "input", config["version"], "chapters_{}.json".format(config["version"])), 'r') as f:
+            books = json.loads(f.read())
+
+        for book in books["books"]:
+            for chapter_num in range(1, get_chapter_count(book["name"])):
+                tasks.append((config, book["name"], chapter_num, debug))
+
+    with instrument.stage("parse"):
+        if args["incremental"]:
+            problem_verses = parse_incremental(tasks, jobs=args["jobs"], cached_versions=cached_versions)
+        else:
+            problem_verses = parse_chapters(tasks, jobs=args["jobs"], cached_versions=cached_versions)
+    bible_cache.save_disk_cache()
 
-                                # If the element doesn't have previous siblings or isn't
-                                # an h3, then it needs a paragraph mark.
-                                if not passage.previous_sibling:
-                                    text += "¶ "
-
-                                # Poetry check.
-                                # Does this element have a poetry encestor?
-                                if passage.find_parents("div", {"class": "poetry"}):
-                                    # Is this element indented?
-                                    # The following will calculate how many 
-                                    # indent levels are needed.
-                                    for parent in passage.find_parents("span"):
-                                        for clsstr in parent.attrs['class']:
-                                            m = re.search("indent-(\d+)", clsstr)
-                                            if m:
-                                                if m.groups(0):
-                                                    indent_string = INDENT * int(m.groups(0)[0])
-                                                    continue
-                                    # newlines after the first poetry line.
-                                    if i == 0:
-                                        text += INDENT
-                                    else:
-                                        # lines at the same indent level may have leading spaces (2nd line in Gen 1:27)
-                                        if passage.previous_sibling:
-                                            if passage.previous_sibling.has_attr("class"):
-                                                for clsstr in passage.previous_sibling.attrs["class"]:
-                                                    m = re.search("indent-(\d+)-breaks", clsstr)
-                                                    if m:
-                                                        previous_text = passage.previous_sibling.text
-                                                        leading_indent = previous_text.replace(u'\xa0', ' ')
-                                                        text = text + leading_indent
-                                        else:
-                                            text = text # + "\n" + INDENT
-
-                                    # So far we've been dealing with parent tags, format_tag
-                                    # will format the element with the text.
-                                    text = format_tag(config, text, passage)
-
-                                    # Each line of poetry should have a newline at the end
-                                    text += "\n" + INDENT
-                                    if config["output_format"] == "html":
-                                        indent_string = INDENT.replace(" ", "&nbsp;")
-                                    else:
-                                        indent_string = INDENT
-                                    i += 1
-                                else:
-                                    # So far we've been dealing with parent tags, format_tag
-                                    # will format the element with the text.
-                                    text = format_tag(config, text, passage)
-
-                        # Set the verse's text to all the text accumulated.
-                        v.text += text
-
-                # Find footnotes on the page.
-                if soup.find("div", {"class": "footnotes"}):
-
-                    # Each footnote is stored in a orderered list item.
-                    footnotes = soup.find("div", {"class": "footnotes"}).find_all("li")
-                    for footnote in footnotes:
-                        store = {}
-                        store["text"] = ""
-                        verse_id = None
-                        c = None
-                        v = None
-
-                        # Each footnote will be referenced with something like fen-NRSVUE-30261a.
-                        # The last letter(s) after the digits represent the footnote "letter".
-                        ref = re.search("[A-Za-z]+-[A-Za-z]+-\d+([a-z]+)", footnote.attrs["id"]).groups()[0]
-
-                        # Find the footnote href element.
-                        # In the NRSVUE this is represented as a two sets of digits separated by a dot. i.e. 10:15
-                        # In the ASV this is a whole verse refeernce. i.e. Genesis 1:1
-                        if footnote.find("a"):
-                            store["verse_ref"] = footnote.find("a").text
-                        
-                        # Find the text of the footnote. Format as necessary.
-                        if footnote.find("span", {"class": "footnote-text"}):
-                            objs = footnote.find("span", {"class": "footnote-text"})
-                            for obj in objs:
-                                store["text"] = format_footnote(store["text"], obj)
-                        try:
-                            # In the NSRVUE the footnote may be formatted like
-                            # 10.15
-                            # 2.31-32 (1 Samuel 2:31, 1 Kings 4:20-21) bible.convert_references_to_verse_ids(bible.get_references("1 Samuel 2:31-32"))
-                            # 34.17-35.2 (Isaiah 35:17) bible.convert_references_to_verse_ids(bible.get_references("Isaiah 34:17-35:2"))
-                            # pythonbible makes this easy.
-                            # This will only work where biblegateway is formatting the footnote like "1.2".
-                            if this_book.version == "NRSVUE":
-                                references = bible.get_references("{} {}".format(this_book.short_title, store["verse_ref".replace(".", ":")]))
-                                verse_ids = bible.convert_references_to_verse_ids(references)
-                            elif this_book.version == "ASV":
-                                references = bible.get_references("{}".format(store["verse_ref"]))
-                                verse_ids = bible.convert_references_to_verse_ids(references)
-                            
-                            for verse_id in verse_ids:
-                                found_verse_object = next((item for item in this_book.verses if item.verse_id == verse_id), None)
-                                if found_verse_object:
-                                    found_verse_object.add_footnote({ref: store["text"]})
-                        except ValueError as e:
-                            problem_verses.append("No valid verse format found in {} {}.".format(this_book.book, store["verse_ref"]))
-
-                        
-
-                # Cross references
-                if soup.find("div", {"class": "crossrefs"}):
-                    # Each set of cross references is stored in a orderered list item.
-                    crossrefs = soup.find("div", {"class": "crossrefs"}).find_all("li")
-                    for crossref in crossrefs:
-                        store = {}
-                        store["text"] = ""
-
-                        # List of found references in the html.
-                        store["clist"] = []
-                        
-                        # Each footnote will be referenced with something like cen-NRSVUE-2B.
-                        # The last uppercase letter(s) after the digits represent the footnote "letter".
-                        ref = re.search("[A-Za-z]+-[A-Za-z]+-\d+([A-Z]+)", crossref.attrs["id"]).groups()[0]
-                        
-                        # Find the footnote href element.
-                        # In the NRSVUE this is represented as a two sets of digits separated by a dot. i.e. 10:15
-                        try:
-                            if crossref.find("a"):
-                                store["verse_ref"] = crossref.find("a").text
-
-                                # Full text of a reference is found in a data-bibleref attribute
-                                clist = [r.strip() for r in crossref.find(class_="crossref-link").attrs["data-bibleref"].split(",")]
-
-                                source_verse = bible.get_references("{} {}".format(this_book.short_title, store["verse_ref".replace(".", ":")]))
-                                source_verse_id = bible.convert_reference_to_verse_ids(source_verse[0])
-                                for c in clist:
-                                    found_verse_object = next((item for item in this_book.verses if item.verse_id == source_verse_id[0]), None)
-                                    found_verse_object.add_crossref({ref: c})
-                                    # TODO Think about how to store references like Job 38.26–28 or Gen 3.7, 10, 11.
-                                    # verse_ids = bible.convert_references_to_verse_ids(bible.get_references(c))
-                                    # if verse_ids:
-                                    #     for verse_id in verse_ids:
-                                    #         found_verse_object = next((item for item in this_book.verses if item.verse_id == verse_id), None)
-                                    #         if found_verse_object:
-                                    #             found_verse_object.add_crossref({ref: verse_id})
-                        except ValueError as e:
-                            problem_verses.append("No valid verse format found in {} {}.".format(this_book.book, store["verse_ref"]))
-                            
-            # Check for empty verses, this indicates something went wrong parsing the verse.
-            # If debug is not None this will be all wonky, do don't show.
-            if debug == None:
-                for v in this_book.verses:
-                    if v.text == "":
-                        problem_verses.append("Something wrong with {} {} {}.".format(this_book.book.title, chapter_num, v.verse))
-                    
-                    if v.text.startswith("\n<b>"):
-                        v.text = v.text[1:]
-
-            if config["output_format"] == "html":
-                Path("books", "output", config["version"], "html").mkdir(parents=True, exist_ok=True)
-                with open(Path("books", "output", config["version"], "html", "{}-{}.json".format(book["name"], str(chapter_num))), "w", encoding='utf-8') as f:
-                    f.write(json.dumps(this_book, indent=4, cls=BookEncoder))
-            elif config["output_foramt"] == "markdown":
-                Path("books", "output", config["version"], "markdown").mkdir(parents=True, exist_ok=True)
-                with open(Path("books", "output", config["version"], "html", "{}-{}.json".format(book["name"], str(chapter_num))), "w", encoding='utf-8') as f:
-                    f.write(json.dumps(this_book, indent=4, cls=BookEncoder))
-    
     for problem in problem_verses:
         print(problem)
             
     # TODO space in 2nd clause of Matthew 1:6
     # TODO double line breaks in poetry
     # TODO fix James 1 in NRSVUE
+
+if __name__ == '__main__':
+    arg_desc = "Command line switches are optional."
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description = arg_desc)
+    add_arguments(parser)
+    instrument.run(main, vars(parser.parse_args()), "parse")
@@ -0,0 +1,63 @@
+# How parse.py writes the formatting it finds on a BibleGateway page (section
+# headings, footnote letters, the small caps LORD) into the verse text. The
+# output_format in config.json picks the renderer, parse.py -f can render
+# several formats from the same parsed page.
+
+class Renderer:
+    """Renders plain text. Subclasses only change the markup around it."""
+    name = None
+    bold_start = ""
+    bold_end = ""
+    italic_start = ""
+    italic_end = ""
+
+    def bold(self, text):
+        return "{}{}{}".format(self.bold_start, text, self.bold_end)
+
+    def italic(self, text):
+        return "{}{}{}".format(self.italic_start, text, self.italic_end)
+
+    def heading(self, text, first):
+        # Headings get a line of their own, the first one in a verse doesn't
+        # need a newline before it.
+        if first:
+            return "{}\n".format(self.bold(text))
+        return "\n{}\n".format(self.bold(text))
+
+    def note(self, text):
+        # Footnote and cross reference letters inside the verse, i.e. [a] or (A).
+        return (text.replace("[", " {}[".format(self.italic_start)).replace("]", "]{}".format(self.italic_end))
+            .replace("(", " {}(".format(self.italic_start)).replace(")", "){}".format(self.italic_end)))
+
+    def small_caps(self):
+        # The only small caps text on BibleGateway is LORD.
+        return self.bold("LORD")
+
+    def link(self, text):
+        # A Tana node reference, the same in every format.
+        return "[[{}]]".format(text)
+
+class HtmlRenderer(Renderer):
+    name = "html"
+    bold_start = "<b>"
+    bold_end = "</b>"
+    italic_start = "<i>"
+    italic_end = "</i>"
+
+class MarkdownRenderer(Renderer):
+    name = "markdown"
+    bold_start = "**"
+    bold_end = "**"
+    italic_start = "__"
+    italic_end = "__"
+
+class PlainTextRenderer(Renderer):
+    name = "text"
+
+RENDERERS = {renderer.name: renderer for renderer in (HtmlRenderer(), MarkdownRenderer(), PlainTextRenderer())}
+OUTPUT_FORMATS = tuple(RENDERERS)
+
+def get_renderer(name):
+    if name not in RENDERERS:
+        raise ValueError("Unknown output format {}. Valid formats are {}.".format(name, ", ".join(OUTPUT_FORMATS)))
+    return RENDERERS[name]
@@ -0,0 +1,193 @@
+import argparse
+import json
+import os
+import re
+import sqlite3
+import time
+import traceback
+
+from pathlib import Path
+
+import pythonbible as bible
+
+import bible_cache
+import instrument
+from crossref_index import index_folder, input_fingerprint, read_verses
+from renderers import get_renderer
+from store import VerseStore, store_path
+from versions import load_configs
+
+# Full text search over the parsed verses. The verse text (without the html
+# or markdown markup) and the footnotes of every verse go into an SQLite FTS5
+# table, an inverted index kept on disk, with the verse id as the rowid.
+# Queries use the FTS5 syntax: words, "quoted phrases", AND / OR / NOT,
+# NEAR(a b, 5) and prefix* searches, i.e.
+#
+#   python.exe search.py -q '"living creature" NOT spirit'
+#
+# The hits can be saved with --select and exported with
+# generate_tif.py --verses.
+
+SEARCH_SOURCES = ["search.py", "crossref_index.py", "model.py", "renderers.py"]
+
+SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS verses USING fts5(
+    text,
+    footnotes,
+    tokenize = "unicode61 remove_diacritics 2"
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+def markup_pattern(renderer):
+    """The markup added by the renderers, none of which should be searched.
+
+    The note letters inside the verse are only removed in the form
+    renderer.note writes them (" <i>[a]</i>", " __(A)__"), so text that
+    happens to be in brackets or parentheses is kept. The text renderer
+    writes the letters without markup (" [a]", " (A)").
+    """
+    notes = r"{}(?:\[[a-z]+\]|\([A-Z]+\)){}".format(re.escape(renderer.italic_start), re.escape(renderer.italic_end))
+    return re.compile(r"{}|</?[bi]>|\*\*|__|\[\[|\]\]|&nbsp;|¶".format(notes))
+
+def search_path(version):
+    return Path(index_folder(version), "search.sqlite")
+
+def plain_text(text, markup):
+    return " ".join(markup.sub("", text).split())
+
+def verse_rows(verses, markup):
+    for verse in verses:
+        yield (
+            verse.verse_id,
+            plain_text(verse.text, markup),
+            " ".join(plain_text(note.text, markup) for note in verse.footnotes)
+        )
+
+def read_fingerprint(path):
+    if not path.exists():
+        return None
+    conn = sqlite3.connect(path)
+    try:
+        row = conn.execute("SELECT value FROM meta WHERE key = 'fingerprint'").fetchone()
+    except sqlite3.DatabaseError:
+        row = None
+    conn.close()
+    return row[0] if row else None
+
+def build_search_index(config, use_store=False, force=False):
+    """Build books/output/{version}/index/search.sqlite unless it is up to date."""
+    path = search_path(config["version"])
+    fingerprint = input_fingerprint(config, use_store, SEARCH_SOURCES)
+    if read_fingerprint(path) == fingerprint and not force:
+        print("The search index for {} is up to date.".format(config["version"]))
+        return
+
+    store = None
+    if use_store:
+        verses_path = store_path(config["version"], config["output_format"])
+        if not verses_path.exists():
+            raise FileNotFoundError("No verse store at {}. Run parse.py -s first.".format(verses_path))
+        store = VerseStore(verses_path)
+
+    # Build next to the old index and swap it in when it's done.
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(".tmp")
+    if tmp.exists():
+        tmp.unlink()
+    conn = sqlite3.connect(tmp)
+    try:
+        conn.executescript(SCHEMA)
+        conn.executemany("INSERT INTO verses (rowid, text, footnotes) VALUES (?, ?, ?)", verse_rows(read_verses(config, store), markup_pattern(get_renderer(config["output_format"]))))
+        # Merge the index segments so queries only read one b-tree.
+        conn.execute("INSERT INTO verses (verses) VALUES ('optimize')")
+        conn.execute("INSERT INTO meta VALUES ('fingerprint', ?)", (fingerprint,))
+        count = conn.execute("SELECT count(*) FROM verses").fetchone()[0]
+        conn.commit()
+    finally:
+        conn.close()
+        if store:
+            store.close()
+    os.replace(tmp, path)
+    print("Indexed {} verses.".format(count))
+
+def verse_name(verse_id):
+    return "{} {}:{}".format(
+        bible.Book(verse_id // 1000000).title,
+        bible_cache.get_chapter_number(verse_id),
+        bible_cache.get_verse_number(verse_id))
+
+def search(version, query, limit=None):
+    """[(verse_id, snippet), ...] for the verses matching an FTS5 query, in Bible order.
+
+    Raises ValueError when the query isn't valid FTS5 syntax.
+    """
+    path = search_path(version)
+    if not path.exists():
+        raise FileNotFoundError("No search index at {}. Run search.py first.".format(path))
+    conn = sqlite3.connect(path)
+    try:
+        # snippet() picks the column (text or footnotes) that matched.
+        try:
+            rows = conn.execute(
+                "SELECT rowid, snippet(verses, -1, '[', ']', '...', 16) FROM verses "
+                "WHERE verses MATCH ? ORDER BY rowid LIMIT ?", (query, -1 if limit is None else limit))
+            return rows.fetchall()
+        except sqlite3.OperationalError as e:
+            raise ValueError("invalid search query: {} ({})".format(query, e))
+    finally:
+        conn.close()
+
+def save_selection(path, query, verse_ids):
+    """Save hits for generate_tif.py --verses."""
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w", encoding='utf-8') as f:
+        f.write(json.dumps({"query": query, "verse_ids": verse_ids}, indent=4))
+
+def load_selection(path):
+    """The verse ids saved by save_selection."""
+    with open(path, "r", encoding='utf-8') as f:
+        return json.loads(f.read())["verse_ids"]
+
+def add_arguments(parser):
+    parser.add_argument("-v", "--versions", nargs = "+", help = "Versions to index or search. Each must be the default version or listed under versions in config.json. If ommited the default version in config.json is used.", required=False)
+    parser.add_argument("-q", "--query", help = "Search the index instead of building it. Words, \"phrases\", AND, OR, NOT, NEAR() and prefix* are allowed.", required=False)
+    parser.add_argument("-n", "--limit", type=int, help = "Only show the first n hits.", required=False)
+    parser.add_argument("--select", help = "Save the verse ids of the hits to this json file for generate_tif.py --verses.", required=False)
+    parser.add_argument("-s", "--store", action="store_true", help = "Build the index from the verse store saved by parse.py -s instead of the chapter json files.", required=False)
+    parser.add_argument("--force", action="store_true", help = "Build the index even if the parsed verses haven't changed.", required=False)
+    instrument.add_arguments(parser)
+
+def main(args):
+    try:
+        for config in load_configs(args["versions"]):
+            if not args["query"]:
+                with instrument.stage("search index {}".format(config["version"])):
+                    build_search_index(config, args["store"], args["force"])
+                continue
+
+            start = time.perf_counter()
+            try:
+                hits = search(config["version"], args["query"], args["limit"])
+            except ValueError as e:
+                print(e)
+                continue
+            seconds = time.perf_counter() - start
+            for verse_id, snippet in hits:
+                print("{}: {}".format(verse_name(verse_id), snippet))
+            print("{} verses in {} ({:.1f} ms).".format(len(hits), config["version"], seconds * 1000))
+            if args["select"]:
+                save_selection(args["select"], args["query"], [verse_id for verse_id, snippet in hits])
+                print("Saved {}".format(args["select"]))
+
+    except Exception:
+        traceback.print_exc()
+
+if __name__ == '__main__':
+    arg_desc = "Command line switches are optional."
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description = arg_desc)
+    add_arguments(parser)
+    instrument.run(main, vars(parser.parse_args()), "search")
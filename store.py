@@ -0,0 +1,116 @@
+import json
+import sqlite3
+
+from pathlib import Path
+
+from model import Note, Verse
+
+# All the parsed verses of a version in one SQLite database, as an
+# alternative to the one json file per chapter written by parse.py. Verses
+# are keyed by verse_id and also indexed by book and chapter so a whole book
+# (or book group) is one sequential read.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS verses (
+    verse_id INTEGER PRIMARY KEY,
+    book INTEGER NOT NULL,
+    chapter INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    version TEXT NOT NULL,
+    clsstr TEXT NOT NULL,
+    text TEXT NOT NULL,
+    footnotes TEXT NOT NULL,
+    crossrefs TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS verses_book_chapter ON verses (book, chapter, position);
+"""
+
+def store_path(version, output_format):
+    return Path("books", "output", version, "verses_{}.sqlite".format(output_format))
+
+def row_to_verse(row):
+    verse_id, version, clsstr, text, footnotes, crossrefs = row
+    return Verse(
+        verse_id,
+        version,
+        clsstr,
+        text,
+        [Note.from_dict(note) for note in json.loads(footnotes)],
+        [Note.from_dict(note) for note in json.loads(crossrefs)]
+    )
+
+class VerseStore:
+    """Read and write the verses of one version and output format.
+
+    book is the pythonbible book number and chapter is the chapter the verse
+    was parsed from (the n in {Book}-{n}.html). position keeps the verses of
+    a chapter in the order parse.py found them. Verses are read back as
+    Verse objects.
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(self.path)
+        # The store can always be rebuilt by parse.py so trade durability
+        # for speed.
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.execute("PRAGMA synchronous = OFF")
+        self.conn.executescript(SCHEMA)
+
+    def write_chapter(self, book, chapter, verses):
+        """Replace a chapter's verses."""
+        rows = []
+        for position, verse in enumerate(verses):
+            rows.append((
+                verse.verse_id,
+                book,
+                chapter,
+                position,
+                verse.version,
+                verse.clsstr,
+                verse.text,
+                json.dumps([note.to_dict() for note in verse.footnotes]),
+                json.dumps([note.to_dict() for note in verse.crossrefs])
+            ))
+        self.conn.execute("DELETE FROM verses WHERE book = ? AND chapter = ?", (book, chapter))
+        self.conn.executemany("INSERT OR REPLACE INTO verses VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def read_chapter(self, book, chapter):
+        rows = self.conn.execute(
+            "SELECT verse_id, version, clsstr, text, footnotes, crossrefs FROM verses "
+            "WHERE book = ? AND chapter = ? ORDER BY position", (book, chapter))
+        return [row_to_verse(row) for row in rows]
+
+    def read_book(self, book, first_chapter=1, last_chapter=None):
+        """Yield (chapter, verse) for a book in chapter and verse order."""
+        if last_chapter is None:
+            last_chapter = 1000
+        rows = self.conn.execute(
+            "SELECT chapter, verse_id, version, clsstr, text, footnotes, crossrefs FROM verses "
+            "WHERE book = ? AND chapter BETWEEN ? AND ? ORDER BY chapter, position",
+            (book, first_chapter, last_chapter))
+        for row in rows:
+            yield row[0], row_to_verse(row[1:])
+
+    def read_books(self, books):
+        """Yield (book, chapter, verse) for several books (i.e. a book group)."""
+        for book in books:
+            for chapter, verse in self.read_book(book):
+                yield book, chapter, verse
+
+    def chapters(self, book):
+        return [row[0] for row in self.conn.execute(
+            "SELECT DISTINCT chapter FROM verses WHERE book = ? ORDER BY chapter", (book,))]
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
@@ -0,0 +1,238 @@
+import argparse
+import multiprocessing
+import time
+import traceback
+
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from pathlib import Path
+
+from tqdm import tqdm
+
+import bible_cache
+import crossref_index
+import download
+import generate_tif
+import instrument
+import parse
+import search
+from backends import PARSERS, get_parser
+from download import Manifest, RateLimiter, chapter_url, download_chapter, fetch_passage, get_chapter_jobs, get_session, write_book_info
+from generate_tif import VerseSerializer, book_node, get_book_groups, open_writer
+from parse import get_chapter_count, init_worker, parse_chapter, write_chapter
+from versions import load_configs
+
+# One entry point for the whole workflow. download, parse and generate run
+# the scripts of the same name. all streams each chapter from BibleGateway
+# through the parser and into the Tana import file without saving the html
+# or the parsed json in between (unless asked to).
+
+def fetch_chapter(s, limiter, config, title, chapter_num, manifest=None):
+    """Return one chapter's passage html.
+
+    With a manifest the chapter is downloaded (or skipped when it already is)
+    and saved like download.py does, then read back from disk. Otherwise it
+    is only kept in memory.
+    """
+    if manifest:
+        download_chapter(s, limiter, config["version"], title, chapter_num, manifest, parser=config["parser"])
+        with open(Path("books", "input", config["version"], "html", "{}-{}.html".format(title, chapter_num)), "r", encoding='utf-8') as f:
+            return f.read()
+
+    start = time.perf_counter()
+    r, content = fetch_passage(s, limiter, chapter_url(config["version"], title, chapter_num), parser=config["parser"])
+    instrument.record(instrument.chapter_key(config["version"], title, chapter_num),
+        download_seconds=time.perf_counter() - start,
+        bytes_downloaded=len(r.content))
+    return content.decode("utf-8")
+
+def parse_html(task):
+    """Parse one (config, book name, chapter, html, save json) task.
+
+    Runs in the parse pool so, like parse.parse_and_write_chapter, it only
+    takes and returns picklable objects. Returns the chapter's problems, the
+    reference strings parsed for the first time, the Verses and the
+    instrument records, if any.
+    """
+    config, book_name, chapter_num, html, save_json = task
+    this_book, problems = parse_chapter(config, book_name, chapter_num, html=html)
+    if save_json:
+        write_chapter(config, book_name, chapter_num, this_book)
+    return problems, bible_cache.pop_new_entries(), this_book.verses, instrument.pop_entries()
+
+def stream_chapters(book_info, b):
+    """(book name, chapter) for every chapter parse.py and generate_tif.py would handle, in export order."""
+    chapters = []
+    for book in book_info["books"]:
+        if b is not None and bible_cache.get_references(book["name"])[0].book not in b:
+            continue
+        for chapter_num in range(1, min(book["chapters"], get_chapter_count(book["name"]))):
+            chapters.append((book["name"], chapter_num))
+    return chapters
+
+def stream_version(s, limiter, config, book_info, b, args, cached_versions):
+    """Download, parse and write the Tana import file for one version.
+
+    Chapters are downloaded by a thread pool and handed to the parse pool as
+    soon as they arrive, while this thread writes the parsed chapters to the
+    export in book order. Only a window of chapters ahead of the one being
+    written is in flight at a time, so memory use doesn't grow with the size
+    of the version.
+
+    Returns the problems found while parsing and the chapters that failed.
+    """
+    chapters = stream_chapters(book_info, b)
+    manifest = Manifest(config["version"]) if args["save_html"] else None
+    window = 4 * max(args["jobs"], args["parse_jobs"])
+
+    downloader = ThreadPoolExecutor(max_workers=args["jobs"])
+    if args["parse_jobs"] > 1:
+        # Worker processes are started while download threads are running,
+        # spawn them instead of forking a process that has threads.
+        parser_pool = ProcessPoolExecutor(max_workers=args["parse_jobs"], mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_worker, initargs=(cached_versions, instrument.enabled()))
+    else:
+        # A single parse thread still overlaps parsing with the downloads.
+        parser_pool = ThreadPoolExecutor(max_workers=1)
+
+    # ready[i] is resolved with parse_html's result for chapters[i].
+    ready = {}
+
+    def resolve(result, future):
+        try:
+            result.set_result(future.result())
+        except Exception as e:
+            result.set_exception(e)
+
+    def downloaded(i, result, future):
+        book_name, chapter_num = chapters[i]
+        try:
+            parsed = parser_pool.submit(parse_html, (config, book_name, chapter_num, future.result(), args["save_json"]))
+        except Exception as e:
+            # The download failed (or the pipeline is shutting down).
+            result.set_exception(e)
+            return
+        parsed.add_done_callback(partial(resolve, result))
+
+    def submit(i):
+        book_name, chapter_num = chapters[i]
+        ready[i] = Future()
+        fetched = downloader.submit(fetch_chapter, s, limiter, config, book_name, chapter_num, manifest)
+        fetched.add_done_callback(partial(downloaded, i, ready[i]))
+
+    problem_verses = []
+    failed = []
+    try:
+        for i in range(min(window, len(chapters))):
+            submit(i)
+
+        with open_writer(config, args["output"], args["max_nodes"], args["max_bytes"], VerseSerializer(args["shared_values"], args["compact"])) as writer:
+            for i, (book_name, chapter_num) in enumerate(tqdm(chapters, unit="chapter")):
+                if i + window < len(chapters):
+                    submit(i + window)
+                if args["shared_values"] and (i == 0 or chapters[i - 1][0] != book_name):
+                    book_num = bible_cache.get_references(book_name)[0].book.value
+                    writer.write_node(book_node(book_name, book_num, [c for b, c in chapters if b == book_name]))
+                try:
+                    problems, entries, verses, records = ready.pop(i).result()
+                except Exception as e:
+                    tqdm.write("Failed {} {}: {}".format(book_name, chapter_num, e))
+                    failed.append("{}-{}".format(book_name, chapter_num))
+                    continue
+
+                problem_verses.extend(problems)
+                bible_cache.merge_entries(entries)
+                instrument.merge_entries(records)
+                start = time.perf_counter()
+                for verse in verses:
+                    writer.write_verse(book_name, verse)
+                instrument.record(instrument.chapter_key(config["version"], book_name, chapter_num),
+                    generate_seconds=time.perf_counter() - start,
+                    nodes=len(verses))
+    finally:
+        downloader.shutdown(cancel_futures=True)
+        parser_pool.shutdown(cancel_futures=True)
+        if manifest:
+            manifest.save()
+
+    return problem_verses, failed
+
+def run_all(args):
+    # All versions share one session and one rate limiter, see download.py.
+    s = get_session(args["jobs"])
+    limiter = RateLimiter(args["rate"], burst=args["jobs"])
+    html_parser = get_parser(args["parser"])
+    b = get_book_groups(args["books"])
+
+    cached_versions = []
+    for config in load_configs(args["versions"]):
+        config["parser"] = html_parser
+        config["store"] = False
+        if not args["no_cache"]:
+            bible_cache.load_disk_cache(config["version"])
+            cached_versions.append(config["version"])
+
+        print(config["version"])
+        with instrument.stage("book list"):
+            book_info, version_jobs = get_chapter_jobs(s, config)
+        # The book list is tiny and parse.py and generate_tif.py need it
+        # for later runs, so it is always saved.
+        write_book_info(book_info)
+
+        with instrument.stage("all {}".format(config["version"])):
+            problem_verses, failed = stream_version(s, limiter, config, book_info, b, args, cached_versions)
+        for problem in problem_verses:
+            print(problem)
+        if failed:
+            print("{} chapters failed and are missing from the export: {}".format(len(failed), ", ".join(failed)))
+
+    bible_cache.save_disk_cache()
+
+def add_all_arguments(parser):
+    parser.add_argument("-v", "--versions", nargs = "+", help = "Versions to build. Each must be the default version or listed under versions in config.json. If ommited the default version in config.json is built.", required=False)
+    parser.add_argument("-b", "--books", nargs = "+", help = "Books groups to include. Only these chapters are downloaded. See README.md for valid options.", required=False)
+    parser.add_argument("-o", "--output", help = "Output file name. Will be saved in output/{version}/tif/{input}.json). If ommited will default to {version}.json.", required=False)
+    parser.add_argument("-j", "--jobs", type=int, default=1, help = "Number of chapters to download at the same time. Defaults to 1.", required=False)
+    parser.add_argument("--parse-jobs", type=int, default=1, help = "Number of processes used to parse chapters. Defaults to 1 (a single parse thread).", required=False)
+    parser.add_argument("-r", "--rate", type=float, default=2.0, help = "Maximum requests per second sent to BibleGateway. 0 disables the limit. Defaults to 2.", required=False)
+    parser.add_argument("-p", "--parser", choices=PARSERS, help = "html parser used by BeautifulSoup. Defaults to html.parser.", required=False)
+    parser.add_argument("--save-html", action="store_true", help = "Also save the html like download.py does. Chapters already in the manifest are read from disk instead of downloaded.", required=False)
+    parser.add_argument("--save-json", action="store_true", help = "Also save the parsed chapter json like parse.py does.", required=False)
+    parser.add_argument("--max-nodes", type=int, help = "Split the output into files of at most this many nodes (counting nested nodes).", required=False)
+    parser.add_argument("--max-bytes", type=int, help = "Split the output into files of at most this many bytes.", required=False)
+    parser.add_argument("--shared-values", action="store_true", help = "Write one node for each book and chapter and point the Book (abbr), Book and Chapter fields of every verse at them, see generate_tif.py.", required=False)
+    parser.add_argument("--compact", action="store_true", help = "Write a smaller file: minified, with short uids inside each verse and no empty Footnotes fields.", required=False)
+    parser.add_argument("--no-cache", action="store_true", help = "Don't load or save parsed references in books/output/{version}/cache.", required=False)
+    instrument.add_arguments(parser)
+
+def main(args):
+    try:
+        run_all(args)
+    except Exception:
+        traceback.print_exc()
+
+COMMANDS = {
+    "download": (download, "Download the html of each chapter (download.py)."),
+    "parse": (parse, "Parse the downloaded html into verse json (parse.py)."),
+    "index": (crossref_index, "Index the footnote links and cross references of the parsed verses (crossref_index.py)."),
+    "search": (search, "Build the full text search index or search the parsed verses (search.py)."),
+    "generate": (generate_tif, "Generate the Tana import file from the parsed verses (generate_tif.py)."),
+}
+
+if __name__ == '__main__':
+    arg_desc = "Download, parse and generate Tana import files. Run a step on its own or all of them with all."
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description = arg_desc)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    for name, (module, help) in COMMANDS.items():
+        command = subparsers.add_parser(name, help = help, description = help)
+        module.add_arguments(command)
+        command.set_defaults(main=module.main)
+
+    command = subparsers.add_parser("all", help = "Stream every chapter from download to the Tana import file.", description = "Stream every chapter from download to the Tana import file without saving the html or json in between.")
+    add_all_arguments(command)
+    command.set_defaults(main=main)
+
+    args = vars(parser.parse_args())
+    command_main = args.pop("main")
+    instrument.run(command_main, args, args.pop("command"))
@@ -0,0 +1,19 @@
+from crossref_index import CROSSREF, verse_links
+from model import Note, Verse
+
+def crossref_verse(*notes):
+    # Genesis 2:5, so a bare verse number read against the verse's own
+    # chapter would land in Genesis 2.
+    return Verse(1002005, "ASV", "Gen-2-5", crossrefs=[Note(ref, text) for ref, text in notes])
+
+def linked_verses(verse):
+    return [(note_num, ref.book.value, ref.start_chapter, ref.start_verse)
+        for kind, note_num, refs in verse_links(verse) if kind == CROSSREF for ref in refs]
+
+def test_split_list_keeps_book_and_chapter():
+    verse = crossref_verse(("A", "Gen 3.7"), ("A", "10"), ("A", "11"))
+    assert linked_verses(verse) == [(0, 1, 3, 7), (1, 1, 3, 10), (2, 1, 3, 11)]
+
+def test_new_key_starts_from_the_verse():
+    verse = crossref_verse(("A", "Exod 4:2"), ("B", "10"))
+    assert linked_verses(verse) == [(0, 2, 4, 2), (1, 1, 2, 10)]
@@ -0,0 +1,41 @@
+import pytest
+import requests
+
+import download
+
+class Response:
+    def __init__(self, status_code, text):
+        self.status_code = status_code
+        self.text = text
+        self.content = text.encode("utf-8")
+        self.ok = status_code < 400
+        self.headers = {}
+
+    def raise_for_status(self):
+        if not self.ok:
+            raise requests.HTTPError("{} error".format(self.status_code))
+
+class Session:
+    def __init__(self, response):
+        self.response = response
+
+    def get(self, url, headers=None):
+        return self.response
+
+@pytest.mark.parametrize("response", [Response(429, "Too many requests"), Response(200, "<html><body>Not found</body></html>")])
+def test_failed_chapter_keeps_the_saved_copy(tmp_path, monkeypatch, response):
+    monkeypatch.chdir(tmp_path)
+    chapter = tmp_path / "books" / "input" / "TEST" / "html" / "Genesis-1.html"
+    chapter.parent.mkdir(parents=True)
+    chapter.write_bytes(b"<div class=\"passage-col\">good</div>")
+    manifest = download.Manifest("TEST")
+    manifest.entries = {"Genesis-1": {"url": "old"}}
+
+    failed = []
+    results = download.download_chapters(Session(response), download.RateLimiter(0), [("TEST", "Genesis", 1)],
+        manifests={"TEST": manifest}, revalidate=True, failed=failed)
+
+    assert results == {"failed": 1}
+    assert failed == ["TEST Genesis 1"]
+    assert chapter.read_bytes() == b"<div class=\"passage-col\">good</div>"
+    assert manifest.entries == {"Genesis-1": {"url": "old"}}
@@ -0,0 +1,39 @@
+import pytest
+
+from generate_tif import ShardedTifWriter, TifWriter, VerseSerializer, verse_node
+from model import Note, Verse
+
+COMPACT = VerseSerializer(compact=True)
+
+def test_uid_map_only_written_with_nodes(tmp_path):
+    with TifWriter(tmp_path / "empty.json", serializer=COMPACT, uid_map=tmp_path / "empty-uids.json"):
+        pass
+    assert not (tmp_path / "empty-uids.json").exists()
+
+    with TifWriter(tmp_path / "one.json", serializer=COMPACT, uid_map=tmp_path / "one-uids.json") as writer:
+        writer.write_node({"type": "node", "uid": "1", "name": "one"})
+    assert (tmp_path / "one.json").exists()
+    assert (tmp_path / "one-uids.json").exists()
+
+def test_sharded_uid_map_only_written_with_nodes(tmp_path):
+    with ShardedTifWriter(tmp_path, "empty", max_nodes=1, serializer=COMPACT, uid_map=tmp_path / "empty-uids.json"):
+        pass
+    assert not (tmp_path / "empty-uids.json").exists()
+
+    with ShardedTifWriter(tmp_path, "two", max_nodes=1, serializer=COMPACT, uid_map=tmp_path / "two-uids.json") as writer:
+        writer.write_node({"type": "node", "uid": "1", "name": "one"})
+        writer.write_node({"type": "node", "uid": "2", "name": "two"})
+    assert (tmp_path / "two-002.json").exists()
+    assert (tmp_path / "two-uids.json").exists()
+
+@pytest.mark.parametrize("shared_values", [False, True])
+@pytest.mark.parametrize("compact", [False, True])
+def test_serializer_writes_the_verse_node(shared_values, compact):
+    serializer = VerseSerializer(shared_values, compact)
+    assert serializer.compact == compact
+    for verse in (
+        Verse(19023001, "TEST", "Ps-23-1", "The LORD is my shepherd"),
+        Verse(19023002, "TEST", "Ps-23-2", "He maketh me to lie down", [Note("a", "Or, pastures")], [Note("A", "Ezek 34:14")])
+    ):
+        node = verse_node("Psalms", verse, shared_values=shared_values, compact=compact)
+        assert serializer.serialize("Psalms", verse, summary=False)[0] == serializer.node_start + serializer.dumps(node).lstrip()
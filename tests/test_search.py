@@ -0,0 +1,41 @@
+import sqlite3
+
+import pytest
+
+import search
+
+@pytest.fixture
+def index(tmp_path, monkeypatch):
+    # A search index with one verse, where search.py looks for it.
+    monkeypatch.chdir(tmp_path)
+    path = search.search_path("TEST")
+    path.parent.mkdir(parents=True)
+    conn = sqlite3.connect(path)
+    conn.executescript(search.SCHEMA)
+    conn.execute("INSERT INTO verses (rowid, text, footnotes) VALUES (?, ?, ?)", (19023001, "The LORD is my shepherd", ""))
+    conn.commit()
+    conn.close()
+    monkeypatch.setattr(search, "load_configs", lambda versions: [{"version": "TEST"}])
+
+def run(query):
+    search.main({"versions": None, "query": query, "limit": None, "select": None, "store": False, "force": False})
+
+def test_search(index):
+    assert [verse_id for verse_id, snippet in search.search("TEST", "shepherd")] == [19023001]
+
+def test_bad_query_raises_value_error(index):
+    with pytest.raises(ValueError, match="invalid search query"):
+        search.search("TEST", "foo(")
+
+def test_bad_query_is_reported(index, capsys):
+    run("foo(")
+    out = capsys.readouterr()
+    assert out.out.startswith("invalid search query: foo(")
+    assert "Traceback" not in out.err
+
+@pytest.mark.parametrize("output_format", ["html", "markdown"])
+def test_plain_text_strips_note_letters_only(output_format):
+    renderer = search.get_renderer(output_format)
+    markup = search.markup_pattern(renderer)
+    text = "The {} said{}(LORD) [and]{}you.".format(renderer.bold("LORD"), renderer.note("[a]"), renderer.note("(B)"))
+    assert search.plain_text(text, markup) == "The LORD said (LORD) [and] you."
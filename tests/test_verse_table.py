@@ -0,0 +1,19 @@
+import pythonbible as bible
+
+import bible_cache
+import verse_table
+
+def test_table_stops_at_revelation(tmp_path):
+    table = verse_table.VerseTable(tmp_path / "verse_table.bin")
+    try:
+        assert len(table) == 31102
+        assert table.next_verse(66022021) is None
+        assert table.next_verse(39004006) == 40001001
+        assert table.coordinates(67001001) is None
+    finally:
+        table.close()
+
+def test_chapter_and_verse_numbers():
+    assert (bible_cache.get_chapter_number(19119176), bible_cache.get_verse_number(19119176)) == (119, 176)
+    # Outside the table pythonbible still answers.
+    assert bible_cache.get_chapter_number(67001001) == bible.get_chapter_number(67001001)
@@ -0,0 +1,136 @@
+from array import array
+from pathlib import Path
+
+import pythonbible as bible
+
+from mapped_arrays import MappedArrays, read_header, save_arrays
+
+# Every verse of the 66 books download.py fetches (Genesis through
+# Revelation, no apocrypha) in canonical order, so turning a book,
+# chapter and verse into a verse id, expanding a range or stepping to the next
+# verse are array lookups instead of calls into pythonbible's parser. The
+# columns are int32 arrays:
+#
+#   verse_ids, books, chapters, verses    by ordinal (0 is Genesis 1:1)
+#   chapter_starts                        ordinal of the first verse of each
+#                                         chapter, by book * CHAPTER_SLOTS + chapter
+#                                         (-1 for chapters that don't exist)
+#   chapter_lengths                       verses in each chapter, same slots
+#
+# The table is built the first time it's needed, saved to
+# books/output/verse_table.bin and memory mapped after that. It is built
+# again when the installed pythonbible or BOOKS changes. Verses outside the
+# table (i.e. in the apocrypha) are left to pythonbible by the callers.
+
+TABLE_PATH = Path("books", "output", "verse_table.bin")
+
+# Psalms has the most chapters.
+CHAPTER_SLOTS = 151
+
+# The Protestant canon, Genesis as 1 through Revelation as 66.
+BOOKS = [book for book in bible.Book if 1 <= book.value <= 66]
+
+BOOK_PLACE = 1000000
+CHAPTER_PLACE = 1000
+
+def build_arrays():
+    arrays = {name: array("i") for name in ("verse_ids", "books", "chapters", "verses")}
+    slots = (max(book.value for book in BOOKS) + 1) * CHAPTER_SLOTS
+    chapter_starts = array("i", [-1]) * slots
+    chapter_lengths = array("i", [0]) * slots
+    for book in sorted(BOOKS, key=lambda book: book.value):
+        for chapter in range(1, bible.get_number_of_chapters(book) + 1):
+            count = bible.get_number_of_verses(book, chapter)
+            slot = book.value * CHAPTER_SLOTS + chapter
+            chapter_starts[slot] = len(arrays["verse_ids"])
+            chapter_lengths[slot] = count
+            for verse in range(1, count + 1):
+                arrays["verse_ids"].append(book.value * BOOK_PLACE + chapter * CHAPTER_PLACE + verse)
+                arrays["books"].append(book.value)
+                arrays["chapters"].append(chapter)
+                arrays["verses"].append(verse)
+    arrays["chapter_starts"] = chapter_starts
+    arrays["chapter_lengths"] = chapter_lengths
+    return arrays
+
+class VerseTable:
+    """The verse table saved at path, built first if it is missing or stale."""
+    def __init__(self, path=TABLE_PATH):
+        header = read_header(path)
+        books = [book.value for book in BOOKS]
+        if header is None or header.get("pythonbible") != bible.__version__ or header.get("books") != books:
+            save_arrays(path, build_arrays(), pythonbible=bible.__version__, books=books)
+        self._mapped = MappedArrays(path)
+        a = self._mapped.arrays
+        self.verse_ids = a["verse_ids"]
+        self.books = a["books"]
+        self.chapters = a["chapters"]
+        self.verses = a["verses"]
+        self.chapter_starts = a["chapter_starts"]
+        self.chapter_lengths = a["chapter_lengths"]
+
+    def __len__(self):
+        return len(self.verse_ids)
+
+    def ordinal(self, book, chapter, verse):
+        """Position of a verse in canonical order, None if there is no such verse."""
+        if not 0 < chapter < CHAPTER_SLOTS:
+            return None
+        slot = book * CHAPTER_SLOTS + chapter
+        if slot >= len(self.chapter_starts) or not 0 < verse <= self.chapter_lengths[slot]:
+            return None
+        return self.chapter_starts[slot] + verse - 1
+
+    def ordinal_of(self, verse_id):
+        book, rest = divmod(verse_id, BOOK_PLACE)
+        chapter, verse = divmod(rest, CHAPTER_PLACE)
+        return self.ordinal(book, chapter, verse)
+
+    def verse_id(self, book, chapter, verse):
+        """The verse id for a book number, chapter and verse, None if there is no such verse."""
+        ordinal = self.ordinal(book, chapter, verse)
+        return None if ordinal is None else self.verse_ids[ordinal]
+
+    def coordinates(self, verse_id):
+        """(book, chapter, verse) for a verse id, None if there is no such verse."""
+        ordinal = self.ordinal_of(verse_id)
+        if ordinal is None:
+            return None
+        return self.books[ordinal], self.chapters[ordinal], self.verses[ordinal]
+
+    def expand(self, start_id, end_id):
+        """Every verse id from start_id to end_id, None if either isn't a verse."""
+        return self._slice(self.ordinal_of(start_id), self.ordinal_of(end_id))
+
+    def expand_range(self, book, start_chapter, start_verse, end_book, end_chapter, end_verse):
+        """Every verse id in a range (i.e. a pythonbible reference), None if an end isn't a verse."""
+        return self._slice(self.ordinal(book, start_chapter, start_verse), self.ordinal(end_book, end_chapter, end_verse))
+
+    def _slice(self, start, end):
+        if start is None or end is None or end < start:
+            return None
+        return self.verse_ids[start:end + 1].tolist()
+
+    def next_verse(self, verse_id):
+        ordinal = self.ordinal_of(verse_id)
+        if ordinal is None or ordinal + 1 >= len(self.verse_ids):
+            return None
+        return self.verse_ids[ordinal + 1]
+
+    def previous_verse(self, verse_id):
+        ordinal = self.ordinal_of(verse_id)
+        if not ordinal:
+            return None
+        return self.verse_ids[ordinal - 1]
+
+    def close(self):
+        self._mapped.close()
+
+_table = None
+
+def get_table():
+    """The VerseTable shared by the whole process."""
+    global _table
+    if _table is None:
+        _table = VerseTable()
+    return _table
@@ -0,0 +1,29 @@
+import json
+
+from pathlib import Path
+
+def load_configs(versions=None, path=Path("config.json")):
+    """Build one config object per Bible version.
+
+    config.json holds the default human_name / version pair and, optionally,
+    a "versions" object that maps other version abbreviations to their
+    BibleGateway human_name. When versions is None (or empty) only the default
+    version is returned. Every other setting in config.json (i.e.
+    output_format) is shared by all the returned configs.
+    """
+    with open(path, "r") as f:
+        config = json.loads(f.read())
+
+    known = dict(config.get("versions", {}))
+    known[config["version"]] = config["human_name"]
+
+    configs = []
+    for version in versions or [config["version"]]:
+        if version not in known:
+            raise ValueError("Version {} is not listed in the versions in {}.".format(version, path))
+        this_config = {k: v for k, v in config.items() if k != "versions"}
+        this_config["version"] = version
+        this_config["human_name"] = known[version]
+        configs.append(this_config)
+
+    return configs